@@ -25,7 +25,8 @@ import modules
 from modules.Arb import Arb
 from modules.Buffer import ADCDataBuffer
 from modules.DataProcessor import DataProcessor
-from modules.DataStorage import Experiment, ImpedanceSpectrum
+from modules.FitQueue import FitQueue
+from modules.DataStorage import Experiment, ImpedanceSpectrum, average
 from modules.Oscilloscope import Oscilloscope
 from modules.Waveform import Waveform
 from modules.Fitter import Fitter, allowed_circuits, predict_circuit
@@ -105,6 +106,7 @@ class MasterModule():
         for module in self.modules:
             if hasattr(module, 'stop'):
                 module.stop()
+        self.close_experiment()
     
     def make_ready(self):
         '''
@@ -113,8 +115,19 @@ class MasterModule():
         time.sleep(3)
         self.ABORT = False
                 
+    def close_experiment(self):
+        # Finish its queued fits first, so they are saved and indexed
+        if hasattr(self, 'FitQueue'):
+            self.FitQueue.drain(self.experiment)
+        self.experiment.close()
+    
     def set_experiment(self, Experiment):
+        self.close_experiment()
         self.experiment = Experiment
+        if hasattr(self, 'GUI'):
+            Experiment.save_txt = self.GUI.save_txt_bool.get()
+            if self.GUI.save_raw_bool.get():
+                Experiment.enable_raw_archive()
         return
     
     
@@ -185,6 +198,7 @@ class GUI():
         self.root = root
         self.params = {}
         self.last_spectrum = None
+        self.last_fit = None
         self._running = False
         
         root.title('FFT-EIS Controller')
@@ -323,6 +337,27 @@ class GUI():
                                   'Fastest', *['Fastest', 'Averaging'])
         recording_mode_menu.grid(column=1, row=6, sticky=(E,W))
         
+        # Average individual periods, gives error bars for each spectrum
+        Label(topright, text='Period Averaging: ').grid(
+            column=0, row=7, sticky=(E))
+        self.period_avg_bool = BooleanVar(topright, value=FALSE)
+        Checkbutton(topright, text='', variable=self.period_avg_bool).grid(
+            column=1, row=7, sticky=(W))
+        
+        # Keep raw scope traces so spectra can be reprocessed later
+        Label(topright, text='Save Raw Frames: ').grid(
+            column=0, row=8, sticky=(E))
+        self.save_raw_bool = BooleanVar(topright, value=FALSE)
+        Checkbutton(topright, text='', variable=self.save_raw_bool).grid(
+            column=1, row=8, sticky=(W))
+        
+        # Spectra always go to the binary store, .txt files are optional
+        Label(topright, text='Save .txt Files: ').grid(
+            column=0, row=9, sticky=(E))
+        self.save_txt_bool = BooleanVar(topright, value=FALSE)
+        Checkbutton(topright, text='', variable=self.save_txt_bool).grid(
+            column=1, row=9, sticky=(W))
+        
                               
         
         ###############################
@@ -349,11 +384,14 @@ class GUI():
     def update_plot(self):
         '''
         Called periodically (every 50 ms) by Tk GUI. Checks if a new
-        spectrum has been recorded, and if so, plots it to the figure.
+        spectrum (or fit) has been recorded, and if so, plots it to the figure.
         '''
         if self.master.experiment.spectra:
-            if self.master.experiment.spectra[-1] != self.last_spectrum:
+            # Fits finish in the background, so also redraw when one comes in
+            if (self.master.experiment.spectra[-1] != self.last_spectrum or
+                self.master.experiment.spectra[-1].fit is not self.last_fit):
                 self.last_spectrum = self.master.experiment.spectra[-1]
+                self.last_fit = self.last_spectrum.fit
                 freqs = self.last_spectrum.freqs
                 Z     = self.last_spectrum.Z
                 phase = self.last_spectrum.phase
@@ -525,7 +563,7 @@ class GUI():
         spectra = self.master.experiment.spectra
         
         # Average them together
-        avg_spectrum = spectra[0].average(spectra[1:])
+        avg_spectrum = average(spectra)
         Z     = np.absolute(avg_spectrum.Z)
         phase = avg_spectrum.phase
         
@@ -620,9 +658,12 @@ class GUI():
             return
         temp_expt = Experiment(self.master, name)
         temp_expt.set_waveform(self.master.experiment.waveform)
+        temp_expt.save_txt = self.save_txt_bool.get()
+        self.master.experiment.writer.flush()
         for spectrum in self.master.experiment.spectra:
             spectrum.experiment = temp_expt
             temp_expt.append_spectrum(spectrum)
+        temp_expt.close()
         return
     
     
@@ -768,11 +809,8 @@ class GUI():
             print('No previous spectra to create optimized waveform from!')
             return
         
-        if len(spectra) > 1:
-            #Average them all together
-            avg_spectrum = spectra[0].average(spectra[1:]) 
-        else:
-            avg_spectrum = spectra[0]
+        #Average them all together
+        avg_spectrum = average(spectra)
         
         
         # Normalized, optimized amplitudes
@@ -894,10 +932,12 @@ if __name__ == '__main__':
     arb             = Arb(master, ARB_ADDRESS)
     buffer          = ADCDataBuffer()
     dataProcessor   = DataProcessor(master, buffer)
+    fitQueue        = FitQueue(master)
     oscilloscope    = Oscilloscope(master, buffer, OSC_ADDRESS)
     
     run(master.run)
     run(dataProcessor.run)
+    run(fitQueue.run)
     
     root = Tk()
     try:
@@ -0,0 +1,57 @@
+'''
+Read tables written by modules/ParquetExport.py. Only the requested
+columns are read, and row groups which can't match the filters are
+skipped without being read.
+
+e.g. Rct and Cads of sensor s2 only:
+    df = read_fits(folder, columns=['Rct', 'Cads'], sensor='s2')
+'''
+import os
+
+import pyarrow.parquet as pq
+
+
+
+def read_table(file, columns=None, filters=None, **labels):
+    '''
+    file: .parquet file
+    columns: list of column names to load, default all
+    filters: pyarrow filters, e.g. [('freq', '<', 1000)]
+    labels: equality filters on label columns, e.g. sensor='s2',
+            concentration='10uM'
+
+    Returns: pandas DataFrame
+    '''
+    filters = list(filters or [])
+    for key, val in labels.items():
+        if val is not None:
+            filters.append((key, '=', val))
+    table = pq.read_table(file, columns=columns, filters=filters or None)
+    return table.to_pandas()
+
+
+
+def _path(folder, name):
+    # Accept either the experiment folder or its parquet/ folder
+    if os.path.exists(os.path.join(folder, 'parquet', name)):
+        return os.path.join(folder, 'parquet', name)
+    return os.path.join(folder, name)
+
+
+
+def read_fits(folder, columns=None, sensor=None, concentration=None,
+              filters=None):
+    return read_table(_path(folder, 'fits.parquet'), columns, filters,
+                      sensor=sensor, concentration=concentration)
+
+
+def read_spectra(folder, columns=None, sensor=None, concentration=None,
+                 filters=None):
+    return read_table(_path(folder, 'spectra.parquet'), columns, filters,
+                      sensor=sensor, concentration=concentration)
+
+
+def read_times(folder, columns=None, sensor=None, concentration=None,
+               filters=None):
+    return read_table(_path(folder, 'times.parquet'), columns, filters,
+                      sensor=sensor, concentration=concentration)
@@ -7,10 +7,19 @@ from tkinter.ttk import *
 from tkinter import filedialog
 import os
 import sys
+import time
+from multiprocessing import Pool
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib
-from modules.Fitter import predict_circuit, Fitter
+from modules.Fitter import (predict_circuit, Fitter, fit_spectrum, fit_spectra,
+                            table_guesses)
+from modules.FitCache import FitCache
+from modules.WarmStart import WarmStart
+from modules.GuessTable import get_table
+from modules.funcs import sensor_conc
+from modules.Loader import load_experiment
+from modules.LEVM.LEVM import scratch_dirs
 
 plt.style.use('ffteis.mplstyle')
 # matplotlib.use('Qt5Agg')
@@ -40,11 +49,158 @@ class Spectrum():
         self.freqs = freqs
         self.Z = Z
 
-def fit_all(ax, folder, sequential_fits:bool, plot_every:int, fitter):
+
+def iter_spectra(folder):
+    '''
+    Yields (file name, freqs, Z) of each spectrum in folder
+    '''
+    d = load_experiment(folder)
+    for name, Z in zip(d.names, d.Z):
+        yield name, d.freqs, Z
+
+
+
+def fit_sequence(fit, spectra, start, warm_starts):
+    '''
+    Fit spectra in order, each warm-started from the previous fits of the
+    same sensor
+    
+    fit: function(freqs, Z, initial guess or None, info) returning fit dict
+    spectra: list of (file, freqs, Z)
+    start: index of the first spectrum in the experiment
+    warm_starts: dict of {sensor: WarmStart}, updated with these fits
+    
+    Yields: fit dict of each spectrum
+    '''
+    for i, (file, f, Z) in enumerate(spectra, start):
+        sensor = sensor_conc(file)[0]
+        if sensor not in warm_starts:
+            warm_starts[sensor] = WarmStart()
+        info = {}
+        fits = fit(f, Z, warm_starts[sensor].guess(i), info)
+        warm_starts[sensor].update(i, fits, info)
+        yield fits
+
+
+
+def fit_chunk(job):
+    '''
+    Fit a contiguous run of spectra, in a worker process. With
+    sequential fits, each fit is warm-started from the ones before it,
+    otherwise CNLS fits the whole chunk in one batch. Fits without a warm
+    start are guessed from the guess table, if use_table.
+    
+    job: (engine, circuit, guess, free, list of (file, freqs, Z), index of
+          first spectrum, sequential_fits, fit cache file or None,
+          use_table)
+    
+    Returns: (list of fit dicts, cache hits, cache misses, 
+              {sensor: WarmStart})
+    '''
+    (engine, circuit, guess, free, spectra, start, sequential_fits, db,
+     use_table) = job
+    cache = FitCache(db) if db else None
+    warm_starts = {}
+    table = None
+    if use_table:
+        table = get_table(circuit, spectra[0][1], 
+                          {elem: (guess[elem], free[elem]) for elem in guess})
+    
+    if engine == 'CNLS' and not sequential_fits:
+        Zs = np.array([Z for _, _, Z in spectra])
+        batch_guess = table_guesses(table, Zs, guess) if table else guess
+        fits = fit_spectra(spectra[0][1], Zs, batch_guess, circuit, free, 
+                           cache)
+    else:
+        def fit(f, Z, initial_guess, info):
+            if not initial_guess:
+                initial_guess = table.lookup(Z) if table else guess
+            return fit_spectrum(f, Z, initial_guess, circuit, free, 
+                                engine, timeout=2, cache=cache, info=info)
+        # LEVM's scratch directories are deleted before the pool ends
+        # this worker
+        with scratch_dirs():
+            if not sequential_fits:
+                fits = [fit(f, Z, None, {}) for _, f, Z in spectra]
+            else:
+                fits = list(fit_sequence(fit, spectra, start, warm_starts))
+    
+    if cache is None:
+        return fits, 0, 0, warm_starts
+    cache.close()
+    return fits, cache.hits, cache.misses, warm_starts
+
+
+
+def iter_fits(spectra, sequential_fits, fitter, n_workers=1, chunk_size=50,
+              warm_starts=None):
+    '''
+    Yields the fit of each (file, freqs, Z) in spectra, in order
+    
+    n_workers: int, > 1 to fit in a pool of worker processes. Each worker
+               fits chunk_size spectra at a time, so sequential fits are
+               warm-started from the previous spectra except at the start
+               of each chunk, which starts from the initial guess
+    warm_starts: dict, filled in with {sensor: WarmStart} of sequential
+                 fits
+    '''
+    if not spectra:
+        return
+    if warm_starts is None:
+        warm_starts = {}
+    
+    if n_workers > 1:
+        guess, free = fitter._initial_guess()
+        cache = fitter.cache
+        use_table = fitter.use_table()
+        if use_table:
+            # Build it once here, workers load it from disk
+            get_table(fitter.circuit, spectra[0][1],
+                      {elem: (guess[elem], free[elem]) for elem in guess})
+        jobs = [(fitter.engine, fitter.circuit, guess, free,
+                 spectra[i:i+chunk_size], i, sequential_fits,
+                 cache.db if cache else None, use_table)
+                for i in range(0, len(spectra), chunk_size)]
+        with Pool(n_workers) as pool:
+            # imap returns chunks in order
+            for fits, hits, misses, chunk_warm_starts in pool.imap(fit_chunk, 
+                                                                   jobs):
+                if cache:
+                    cache.hits   += hits
+                    cache.misses += misses
+                for sensor, warm_start in chunk_warm_starts.items():
+                    if sensor not in warm_starts:
+                        warm_starts[sensor] = WarmStart()
+                    warm_starts[sensor].add_stats(warm_start)
+                yield from fits
+        return
+    
+    # Spectra share one frequency axis, so the CNLS engine can fit them
+    # all at once unless each fit starts from the previous one
+    if fitter.engine == 'CNLS' and not sequential_fits:
+        freqs = spectra[0][1]
+        yield from fitter.fit_batch(freqs, np.array([Z for _, _, Z in spectra]))
+        return
+    
+    with scratch_dirs():
+        if not sequential_fits:
+            for _, f, Z in spectra:
+                yield fitter.fit(Spectrum(f, Z))
+            return
+        
+        def fit(f, Z, initial_guess, info):
+            return fitter.fit(Spectrum(f, Z), initial_guess, info=info)
+        yield from fit_sequence(fit, spectra, 0, warm_starts)
+
+
+
+def fit_all(ax, folder, sequential_fits:bool, plot_every:int, fitter,
+            n_workers=1):
     '''
     folder: folder of data files to fit
     sequential_fits: bool, use previous fit as initial guess for next fit
     plot_every: int, plots every nth fit to graph
+    n_workers: int, number of processes to fit in
     '''
     # Set up results file
     j = 0
@@ -72,50 +228,35 @@ def fit_all(ax, folder, sequential_fits:bool, plot_every:int, fitter):
     
     
     # Get number of sensors in this experiment
+    spectra = [(file, f[remove_low:len(f)-remove_high],
+                Z[remove_low:len(Z)-remove_high])
+               for file, f, Z in iter_spectra(folder)]
     sensors = list()
-    for file in os.listdir(folder):
-        if file.endswith('.xlsx'):
-            continue
-        ln = open(os.path.join(folder, file), 'r').readline()
-        if not ln.startswith('<Frequency>'):
-            continue
+    for file, _, _ in spectra:
         if '_' in file:
             sensor, _ = file.split('_')
             if sensor not in sensors:
                 sensors.append(sensor)
     n_sensors = len(sensors)
-        
     
-    i = 0
-    fits = None
+    
+    warm_starts = {}
+    fit_results = iter_fits(spectra, sequential_fits, fitter, n_workers,
+                            warm_starts=warm_starts)
+    out = open(fits_file, 'a')
+    start_time = last_report = time.time()
+    
     plt.pause(0.2)
-    for file in os.listdir(folder):
-        if file.endswith('.xlsx'):
-            continue
-        ln = open(os.path.join(folder, file), 'r').readline()
-        if not ln.startswith('<Frequency>'):
-            continue
-        f, re, im = np.loadtxt(os.path.join(folder,file),
-                               unpack=True, skiprows=1)
-        Z = re +1j*im
-        
-        f = f[remove_low:len(f)-remove_high]
-        Z = Z[remove_low:len(Z)-remove_high]
-        
+    for i, ((file, f, Z), fits) in enumerate(zip(spectra, fit_results)):
         spec = Spectrum(f, Z)
-        initial_guess = None
-        if (i != 0) and (sequential_fits):
-            initial_guess = fits
-        
-        # Do fitting
-        fits = fitter.fit(spec, initial_guess) 
         
         ket = 1/(2*fits['Rct']*fits['Cads'])
-        prntln = f'{file}: '
-        for key,val in fits.items():
-            prntln += f' {key}:' + f'{val:0.2e},'.rjust(6, ' ')
-        prntln += f' ket:{ket:0.2f}'
-        print(prntln)        
+        if n_workers == 1:
+            prntln = f'{file}: '
+            for key,val in fits.items():
+                prntln += f' {key}:' + f'{val:0.2e},'.rjust(6, ' ')
+            prntln += f' ket:{ket:0.2f}'
+            print(prntln)        
         
         # Find the correct time
         if '_' in file:
@@ -133,25 +274,32 @@ def fit_all(ax, folder, sequential_fits:bool, plot_every:int, fitter):
             t = idx
             
         
-        # Save to file
-        with open(fits_file, 'a') as f:
-            if i == 0:
-                header_line = ','.join(key for key in fits.keys())
-                header_line = 'file,time,' + header_line + ',ket'
-                f.write(header_line + '\n')
-            line = ','.join(str(val) for val in fits.values())
-            line = f'{file},{t},' + line + f',{ket}'
-            f.write(line + '\n')
+        # Save to file, in file order
+        if i == 0:
+            header_line = ','.join(key for key in fits.keys())
+            header_line = 'file,time,' + header_line + ',ket'
+            out.write(header_line + '\n')
+        line = ','.join(str(val) for val in fits.values())
+        line = f'{file},{t},' + line + f',{ket}'
+        out.write(line + '\n')
+        
+        # Progress
+        now = time.time()
+        if (now - last_report > 1) or (i == len(spectra) - 1):
+            out.flush()
+            last_report = now
+            rate = (i+1)/(now - start_time)
+            eta  = (len(spectra) - i - 1)/rate
+            print(f'{i+1}/{len(spectra)} fits, {rate:0.1f} fits/s, '
+                  f'ETA {int(eta//60)}:{int(eta%60):02}')
         
             
         # Draw on plot
         if plot_every == 0:
             plt.close()
-            i += 1
             continue
         
         if (i%plot_every != 0):
-            i += 1
             continue
         
         fit_Z = predict_circuit('Sensor', spec.freqs, fits)
@@ -181,8 +329,12 @@ def fit_all(ax, folder, sequential_fits:bool, plot_every:int, fitter):
         fig.canvas.draw_idle()
         # plt.show()
         plt.pause(0.1)
-                
-        i += 1
+    
+    out.close()
+    if fitter.cache:
+        print(fitter.cache.stats())
+    for sensor, warm_start in warm_starts.items():
+        print(f'Fits{f" ({sensor})" if sensor else ""}: {warm_start.stats()}')
     return
         
         
@@ -229,10 +381,16 @@ if __name__ == '__main__':
         end(root)
         sys.exit()
     
+    n_workers = prompt(f'Worker processes (1-{os.cpu_count()}): ',
+                       [str(i) for i in range(1, (os.cpu_count() or 1)+1)])
+    if n_workers in {'q', 'quit', 'exit'}:
+        end(root)
+        sys.exit()
+    
     end(root)    
     fig, ax = plt.subplots(figsize=(6,5), dpi=80)
     fit_all(ax, folder, bool(int(sequential_fits)), 
-            int(plot_every), fitter)
+            int(plot_every), fitter, int(n_workers))
 
     
     
@@ -0,0 +1,339 @@
+import numpy as np
+'''
+In-process complex nonlinear least squares (CNLS) fitting, as an
+alternative to running LEVM.exe. Works on any OS.
+
+Main function to call:
+
+CNLS_fit(freqs, Z, guess, circuit, free_params):
+    returns fits: dict of best-fit parameters, same as LEVM_fit
+
+circuit can be any built-in circuit in Circuits.py (RRC, RRQ, Sensor,
+Randles_uelec, the same circuits as LEVM.py) or a circuit string like
+'R0-p(CPE1,R1-CPE2)'. Fits use the circuit's analytic Jacobian.
+'''
+
+from .Circuits import get_circuit
+
+
+
+def impedance(circuit, freqs, params):
+    '''
+    Z(f) of circuit with params: dict of {element: value}
+    '''
+    return get_circuit(circuit).Z(freqs, params)
+
+
+
+def jacobian(circuit, freqs, params):
+    '''
+    dZ/dparam of circuit with params: dict of {element: value}
+
+    Returns: complex array of shape (n_params, len(freqs)), in the order
+             of get_circuit(circuit).params
+    '''
+    return get_circuit(circuit).jacobian(freqs, params)
+
+
+
+def LM(residuals, x, max_iter=100, ftol=1e-10, xtol=1e-10):
+    '''
+    Levenberg-Marquardt minimization of sum(residuals(x)**2).
+
+    residuals: function of x returning (residual vector, Jacobian)
+    x: initial guess
+
+    Returns: (best x, sum of squared residuals, number of iterations)
+    '''
+    lam = 1e-3
+    r, J = residuals(x)
+    cost = r @ r
+    n_iter = 0
+    for n_iter in range(1, max_iter+1):
+        # Marquardt scaling, so step sizes don't depend on parameter units
+        JTJ = J.T @ J
+        D   = np.diag(JTJ) + 1e-12
+        try:
+            step = np.linalg.solve(JTJ + lam*np.diag(D), -J.T @ r)
+        except np.linalg.LinAlgError:
+            step = np.full(len(x), np.nan)
+
+        r_new, J_new = residuals(x + step)
+        cost_new = r_new @ r_new
+        if cost_new < cost and np.all(np.isfinite(J_new)):
+            converged = (cost - cost_new <= ftol*cost or
+                         np.max(np.abs(step)) <= xtol)
+            x, r, J, cost = x + step, r_new, J_new, cost_new
+            lam = max(lam/10, 1e-12)
+            if converged:
+                break
+        else:
+            lam *= 10
+            if lam > 1e12:
+                break
+    return x, cost, n_iter
+
+
+
+def CNLS_fit(freqs, Z, guess, circuit, free_params, weights=None,
+             max_iter=100, analytic=True, info=None):
+    '''
+    Fit Z to circuit. Drop-in replacement for LEVM_fit.
+
+    Residuals are modulus weighted, i.e. the real and imaginary errors
+    of each point are divided by |Z|, the same as LEVM with IRCH = 3.
+    All parameters are fit as log(value), which keeps them positive and
+    handles parameters several orders of magnitude apart.
+
+    freqs: array of frequencies
+    Z: array of (re - 1j*im) impedances
+    guess: dict of {element: initial guess}
+    circuit: str, name of a built-in circuit or a circuit string
+    free_params: dict of {element: bool}, False to hold element fixed
+    weights: optional array of relative weights for each point
+    analytic: bool, use the circuit's analytic Jacobian. If False, it is
+              estimated by finite differences
+    info: optional dict, filled in with the number of iterations
+          ('n_iter') and final sum of squared residuals ('cost')
+
+    Returns: dict of {element: best-fit value}, or 0 if the fit failed
+    '''
+    try:
+        circuit = get_circuit(circuit)
+    except ValueError as e:
+        print(f'Circuit not recognized by CNLS.py: {e}')
+        raise
+    names, func, dfunc = circuit.params, circuit.func, circuit.dfunc
+
+    freqs = np.asarray(freqs, dtype=float)
+    Z     = np.asarray(Z, dtype=complex)
+    w     = 2*np.pi*freqs
+
+    sigma = np.abs(Z)
+    if weights is not None:
+        sigma = sigma/np.sqrt(weights)
+
+    p0   = np.array([float(guess[name]) for name in names])
+    free = np.array([bool(free_params[name]) for name in names])
+    if any(p0[free] <= 0):
+        print('CNLS.py: free parameters must have positive initial guesses')
+        return 0
+    if not free.any():
+        return {name: val for name, val in zip(names, p0)}
+
+    def params(x):
+        p = p0.copy()
+        p[free] = np.exp(x)
+        return p
+
+    def resid(p):
+        dZ = (func(w, *p) - Z)/sigma
+        return np.concatenate([dZ.real, dZ.imag])
+
+    def residuals(x):
+        p = params(x)
+        if analytic:
+            Z_fit, dZ = dfunc(w, *p)
+            r = (Z_fit - Z)/sigma
+            # d/dlog(p) = p * d/dp
+            dZ = dZ[free]*p[free][:,None]/sigma
+            return (np.concatenate([r.real, r.imag]),
+                    np.concatenate([dZ.real, dZ.imag], axis=1).T)
+
+        # Forward-difference Jacobian in log space
+        r = resid(p)
+        J = np.empty((len(r), len(x)))
+        h = 1e-7
+        for i in range(len(x)):
+            dx = x.copy()
+            dx[i] += h
+            J[:,i] = (resid(params(dx)) - r)/h
+        return r, J
+
+    with np.errstate(all='ignore'):
+        x, cost, n_iter = LM(residuals, np.log(p0[free]), max_iter=max_iter)
+    p = params(x)
+    if info is not None:
+        info.update(n_iter=n_iter, cost=float(cost))
+
+    if not (np.all(np.isfinite(p)) and np.isfinite(cost)):
+        print('CNLS fit failed')
+        return 0
+
+    return {name: float(val) for name, val in zip(names, p)}
+
+
+
+def LM_batch(residuals, x, max_iter=100, ftol=1e-10, xtol=1e-10):
+    '''
+    Levenberg-Marquardt on many independent problems at once, each with
+    its own damping. Problems drop out as they converge.
+
+    residuals: function of (x, rows) returning residuals, shape
+               (len(rows), m), and transposed Jacobians, shape
+               (len(rows), k, m), of the problems in rows
+    x: (n, k) array of initial guesses
+
+    Returns: (best x, (n,) array of sums of squared residuals)
+    '''
+    x    = np.array(x, dtype=float)
+    n, k = x.shape
+    rows = np.arange(n)
+    lam  = np.full(n, 1e-3)
+    eye  = np.eye(k)
+
+    r, JT = residuals(x, rows)
+    cost = np.einsum('im,im->i', r, r)
+    for _ in range(max_iter):
+        if not len(rows):
+            break
+        JTJ = JT @ JT.transpose(0, 2, 1)
+        D   = np.einsum('ikk->ik', JTJ) + 1e-12
+        A   = JTJ + lam[rows,None,None]*D[:,:,None]*eye
+        g   = (JT @ r[:,:,None])[:,:,0]
+        try:
+            step = np.linalg.solve(A, -g[:,:,None])[:,:,0]
+        except np.linalg.LinAlgError:
+            step = np.full((len(rows), k), np.nan)
+            for i in range(len(rows)):
+                try:
+                    step[i] = np.linalg.solve(A[i], -g[i])
+                except np.linalg.LinAlgError:
+                    pass
+
+        r_new, JT_new = residuals(x[rows] + step, rows)
+        cost_new = np.einsum('im,im->i', r_new, r_new)
+        old  = cost[rows]
+        ok   = (cost_new < old) & np.all(np.isfinite(JT_new), axis=(1,2))
+        done = ok & ((old - cost_new <= ftol*old) |
+                     (np.max(np.abs(step), axis=1) <= xtol))
+
+        # Accept improved steps, raise damping of the rest
+        better = rows[ok]
+        x[better]    += step[ok]
+        cost[better]  = cost_new[ok]
+        r[ok], JT[ok] = r_new[ok], JT_new[ok]
+        lam[better]   = np.maximum(lam[better]/10, 1e-12)
+        lam[rows[~ok]] *= 10
+
+        keep = ~done & (lam[rows] <= 1e12)
+        rows, r, JT = rows[keep], r[keep], JT[keep]
+    return x, cost
+
+
+
+def CNLS_fit_batch(freqs, Z, guess, circuit, free_params, weights=None,
+                   max_iter=100):
+    '''
+    Fit many spectra with the same frequencies at once. Same as calling
+    CNLS_fit on each spectrum, but every iteration evaluates the circuit
+    for all spectra still being fit in one go.
+
+    freqs: array of frequencies
+    Z: (n_spectra, n_freqs) array of impedances
+    guess: dict of {element: initial guess}. Values can be a single
+           number, or an array of one guess per spectrum
+    circuit: str, name of a built-in circuit or a circuit string
+    free_params: dict of {element: bool}, False to hold element fixed
+    weights: optional (n_freqs,) or (n_spectra, n_freqs) array of
+             relative weights. Points with weight 0 are left out
+
+    Returns: list of fit dicts, 0 for any spectrum whose fit failed
+    '''
+    try:
+        circuit = get_circuit(circuit)
+    except ValueError as e:
+        print(f'Circuit not recognized by CNLS.py: {e}')
+        raise
+    names, func, dfunc = circuit.params, circuit.func, circuit.dfunc
+
+    freqs = np.asarray(freqs, dtype=float)
+    Z     = np.atleast_2d(np.asarray(Z, dtype=complex))
+    w     = 2*np.pi*freqs
+    n     = len(Z)
+
+    # 1/sigma of each point
+    inv = 1/np.abs(Z)
+    if weights is not None:
+        inv = inv*np.sqrt(np.broadcast_to(weights, Z.shape))
+    Z_inv = Z*inv
+
+    p0   = np.stack([np.broadcast_to(np.asarray(guess[name], dtype=float), n)
+                     for name in names], axis=1)
+    free = np.array([bool(free_params[name]) for name in names])
+    if np.any(p0[:,free] <= 0):
+        print('CNLS.py: free parameters must have positive initial guesses')
+        return [0]*n
+
+    def params(x, rows):
+        p = p0[rows].copy()
+        p[:,free] = np.exp(x)
+        return p
+
+    def residuals(x, rows):
+        p  = params(x, rows)
+        cols = [col[:,None] for col in p.T]
+        inv_rows = inv[rows]
+        Z_fit, dZ = dfunc(w, *cols)
+        r  = Z_fit*inv_rows - Z_inv[rows]
+        r  = np.concatenate([r.real, r.imag], axis=1)
+        # d/dlog(p) = p * d/dp, shape (rows, free params, freqs)
+        dp = (dZ[free].transpose(1, 0, 2) *
+              p[:,free,None]*inv_rows[:,None])
+        return r, np.concatenate([dp.real, dp.imag], axis=2)
+
+    if free.any():
+        with np.errstate(all='ignore'):
+            x, cost = LM_batch(residuals, np.log(p0[:,free]),
+                               max_iter=max_iter)
+        p = params(x, np.arange(n))
+    else:
+        p, cost = p0, np.zeros(n)
+
+    ok = np.all(np.isfinite(p), axis=1) & np.isfinite(cost)
+    return [dict(zip(names, row)) if good else 0
+            for row, good in zip(p.tolist(), ok)]
+
+
+
+
+#%% Comparison with LEVM
+
+
+
+if __name__ == '__main__':
+    # Fit every spectrum in an experiment folder with both LEVM and CNLS
+    # Usage (from the repo folder): python -m modules.CNLS <experiment folder>
+    import sys
+    from .Loader import load_experiment
+    from .LEVM.LEVM import LEVM_fit
+
+    guess = {'Rs': 500, 'Rct': 30000, 'Cdl': 1e-7, 'n_dl': 1,
+             'Cads': 5e-7, 'n_ads': 0.84}
+    free  = {'Rs': 1, 'Rct': 1, 'Cdl': 1, 'n_dl': 0, 'Cads': 1, 'n_ads': 0}
+
+    d = load_experiment(sys.argv[1])
+    diffs = []
+    levm_runs = True
+    for name, Z in zip(d.names, d.Z):
+        cnls = CNLS_fit(d.freqs, Z, guess, 'Sensor', free)
+        try:
+            levm = LEVM_fit(d.freqs, Z, guess, 'Sensor', free) if levm_runs else 0
+        except OSError as e:
+            # e.g. not on Windows
+            print(f'Could not run LEVM.exe ({e}), showing CNLS fits only')
+            levm_runs, levm = False, 0
+        if not levm_runs and type(cnls) == dict:
+            print(name, ' '.join(f'{key}:{val:.4g}' for key, val in cnls.items()))
+            continue
+        if type(levm) != dict or type(cnls) != dict:
+            print(f'{name}: fit failed')
+            continue
+        diff = {key: cnls[key]/levm[key] - 1 for key in levm}
+        diffs.append(list(diff.values()))
+        print(name, ' '.join(f'{key}:{val:+.2%}' for key, val in diff.items()))
+
+    if diffs:
+        print('Max relative difference:')
+        for key, val in zip(levm, np.max(np.abs(diffs), axis=0)):
+            print(f'    {key}: {val:.2%}')
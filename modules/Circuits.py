@@ -0,0 +1,331 @@
+import re
+from functools import lru_cache
+
+import numpy as np
+'''
+Equivalent circuits, written as strings like
+
+    R(Rs)-p(CPE(Cdl,n_dl),R(Rct)-CPE(Cads,n_ads))
+
+    -           elements in series
+    p(a,b,...)  elements in parallel
+    R(name)     resistor, one parameter
+    C(name)     capacitor, one parameter
+    L(name)     inductor, one parameter
+    CPE(Q,n)    constant phase element, Z = 1/(Q*(jw)^n)
+
+Elements can also be written without parameter names. R1, C1 and L1 are
+parameters R1, C1 and L1 (any name starting with R, C or L works, e.g.
+Rct), and CPE1 has parameters Q1 and n1. A parameter used by more than
+one element is a single shared parameter.
+
+compile_circuit() turns a string into a Circuit, with vectorized
+functions for Z(w) and its Jacobian dZ/dparam. Compiled circuits are
+cached, so each string is only parsed once.
+
+To add a circuit to the GUI, add it to builtin below.
+'''
+
+
+# Default initial guess/ free or not (bool) for each element type
+element_defaults = {
+    'R'  : ((1000, 1),),
+    'C'  : ((1e-6, 1),),
+    'L'  : ((1e-6, 1),),
+    'CPE': ((1e-6, 1), (0.9, 0)),
+    }
+
+
+# name: (circuit string, {param: (guess, free)} defaults, image file)
+builtin = {
+    'RRC': ('R1-p(R2,C1)',
+            {'R1': (100, 1), 'R2': (1000, 1), 'C1': (1e-6, 1)},
+            'etc/RRC.png'),
+    'Sensor': ('R(Rs)-p(CPE(Cdl,n_dl),R(Rct)-CPE(Cads,n_ads))',
+               {'Rs': (500, 1), 'Rct': (30000, 1), 'Cdl': (1e-7, 1),
+                'n_dl': (1, 0), 'Cads': (5e-7, 1), 'n_ads': (0.84, 0)},
+               'etc/Sensor.png'),
+    'RRQ': ('R1-p(R2,CPE1)',
+            {'R1': (100, 1), 'R2': (1000, 1), 'Q1': (1e-6, 1), 'n1': (0.9, 0)},
+            None),
+    'Randles_uelec': ('R1-p(C(Q1),R2-p(R3,CPE2))',
+                      {'R1': (100, 1), 'R2': (1000, 1), 'R3': (10000, 1),
+                       'Q1': (1e-7, 1), 'Q2': (1e-6, 1), 'n2': (0.9, 0)},
+                      None),
+    }
+
+
+
+##############################################################################
+#####                      PARSING                                       #####
+##############################################################################
+
+token_re = re.compile(r'\s*(p(?=\s*\()|[A-Za-z_]\w*|\(|\)|,|-)')
+
+
+def tokenize(string):
+    tokens = []
+    pos = 0
+    string = string.strip()
+    while pos < len(string):
+        m = token_re.match(string, pos)
+        if not m:
+            raise ValueError(f'Invalid circuit "{string}" at "{string[pos:]}"')
+        tokens.append(m.group(1))
+        pos = m.end()
+    return tokens
+
+
+
+def parse(string):
+    '''
+    Returns: tree of ('series', [nodes]), ('parallel', [nodes]) and
+             (element type, [parameter names]) tuples
+    '''
+    tokens = tokenize(string)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take(expected=None):
+        nonlocal pos
+        tok = peek()
+        if tok is None or (expected and tok != expected):
+            raise ValueError(f'Invalid circuit "{string}": expected '
+                             f'{expected or "element"}, got {tok}')
+        pos += 1
+        return tok
+
+    def series():
+        nodes = [term()]
+        while peek() == '-':
+            take('-')
+            nodes.append(term())
+        return nodes[0] if len(nodes) == 1 else ('series', nodes)
+
+    def term():
+        tok = take()
+        if tok == 'p':
+            take('(')
+            nodes = [series()]
+            while peek() == ',':
+                take(',')
+                nodes.append(series())
+            take(')')
+            return ('parallel', nodes)
+
+        kind = 'CPE' if tok.startswith('CPE') else tok[0]
+        if tok in '(),-' or kind not in element_defaults:
+            raise ValueError(f'Invalid circuit "{string}": unknown '
+                             f'element {tok}')
+        n = len(element_defaults[kind])
+        if peek() == '(' and tok == kind:
+            # Named parameters, e.g. CPE(Cdl,n_dl)
+            take('(')
+            names = [take()]
+            while peek() == ',':
+                take(',')
+                names.append(take())
+            take(')')
+        elif kind == 'CPE':
+            names = ['Q' + tok[3:], 'n' + tok[3:]]
+        else:
+            names = [tok]
+        if len(names) != n:
+            raise ValueError(f'Invalid circuit "{string}": {kind} takes '
+                             f'{n} parameter(s), got {names}')
+        return (kind, names)
+
+    tree = series()
+    if peek() is not None:
+        raise ValueError(f'Invalid circuit "{string}": unexpected {peek()}')
+    return tree
+
+
+
+##############################################################################
+#####                      COMPILING                                     #####
+##############################################################################
+
+# Elements: function of (jw, log(w), *params) returning (Z, [dZ/dparam])
+
+def _R(jw, log_w, R):
+    return R, [1]
+
+
+def _C(jw, log_w, C):
+    Z = 1/(jw*C)
+    return Z, [-Z/C]
+
+
+def _L(jw, log_w, L):
+    return jw*L, [jw]
+
+
+def _CPE(jw, log_w, Q, n):
+    # 1/(Q*(jw)^n) in polar form, complex powers are slow
+    Z = np.exp(-n*log_w)/Q * np.exp(-0.5j*np.pi*n)
+    return Z, [-Z/Q, -Z*(log_w + 0.5j*np.pi)]
+
+
+elements = {'R': _R, 'C': _C, 'L': _L, 'CPE': _CPE}
+
+
+
+def _compile(node, index):
+    '''
+    node: parse tree
+    index: dict of {param name: position in params}
+
+    Returns: function of (jw, log(w), params) returning 
+             (Z, [(position, dZ/dparam)])
+    '''
+    kind, children = node
+
+    if kind in elements:
+        func = elements[kind]
+        idx  = [index[name] for name in children]
+        def element(jw, log_w, p):
+            Z, grads = func(jw, log_w, *[p[i] for i in idx])
+            return Z, list(zip(idx, grads))
+        return element
+
+    funcs = [_compile(child, index) for child in children]
+
+    if kind == 'series':
+        def series(jw, log_w, p):
+            Z, grads = 0, []
+            for f in funcs:
+                Zi, gi = f(jw, log_w, p)
+                Z = Z + Zi
+                grads.extend(gi)
+            return Z, grads
+        return series
+
+    def parallel(jw, log_w, p):
+        # Z = 1/sum(1/Zi), dZ/dZi = (Z/Zi)^2
+        results = [f(jw, log_w, p) for f in funcs]
+        Y = 0
+        for Zi, _ in results:
+            Y = Y + 1/Zi
+        Z = 1/Y
+        grads = []
+        for Zi, gi in results:
+            scale = (Z/Zi)**2
+            grads.extend((i, g*scale) for i, g in gi)
+        return Z, grads
+    return parallel
+
+
+
+class Circuit():
+    '''
+    Compiled equivalent circuit. Use compile_circuit() to make one.
+
+    params: tuple of parameter names, in order of appearance
+    defaults: dict of {param: (initial guess, free)}
+    func(w, *params): Z at angular frequencies w
+    dfunc(w, *params): Z and array of shape (n_params, *Z.shape) of
+                       dZ/dparam
+
+    Parameters can be scalars or arrays which broadcast against w, e.g.
+    shape (n_spectra, 1) to evaluate many spectra at once.
+    '''
+    def __init__(self, string, defaults=None, img=None):
+        self.string = string
+        self.img    = img
+        tree = parse(string)
+
+        names, kinds = [], {}
+        def walk(node):
+            kind, children = node
+            if kind in elements:
+                for j, name in enumerate(children):
+                    if name not in names:
+                        names.append(name)
+                        kinds[name] = element_defaults[kind][j]
+            else:
+                for child in children:
+                    walk(child)
+        walk(tree)
+
+        # Parameters in the same order as defaults, if given
+        order = list(defaults or {})
+        names.sort(key = lambda name: order.index(name) if name in order 
+                                      else len(order))
+        self.params   = tuple(names)
+        self.defaults = {name: kinds[name] for name in names}
+        self.defaults.update({key: val for key, val in (defaults or {}).items()
+                              if key in self.defaults})
+        self._eval    = _compile(tree, {name: i for i, name in enumerate(names)})
+
+
+    def _call(self, w, p):
+        Z, grads = self._eval(1j*w, np.log(w), p)
+        if np.shape(Z)[-1:] != np.shape(w)[-1:]:
+            # No frequency dependent elements
+            Z = Z + np.zeros_like(w)
+        return Z, grads
+
+
+    def func(self, w, *p):
+        return self._call(w, p)[0]
+
+
+    def dfunc(self, w, *p):
+        Z, grads = self._call(w, p)
+        J = np.zeros((len(self.params),) + np.shape(Z), dtype=complex)
+        for i, g in grads:
+            J[i] += g
+        return Z, J
+
+
+    def Z(self, freqs, params):
+        '''
+        Z(f) with params: dict of {param: value}
+        '''
+        w = 2*np.pi*np.asarray(freqs, dtype=float)
+        return self.func(w, *[params[name] for name in self.params])
+
+
+    def jacobian(self, freqs, params):
+        '''
+        dZ/dparam at f with params: dict of {param: value}
+
+        Returns: complex array of shape (n_params, len(freqs))
+        '''
+        w = 2*np.pi*np.asarray(freqs, dtype=float)
+        return self.dfunc(w, *[params[name] for name in self.params])[1]
+
+
+    def __repr__(self):
+        return f'Circuit({self.string!r})'
+
+
+
+@lru_cache(maxsize=None)
+def compile_circuit(string):
+    '''
+    Returns: Circuit for the circuit string
+    '''
+    return Circuit(string)
+
+
+
+circuits = {name: Circuit(string, defaults, img)
+            for name, (string, defaults, img) in builtin.items()}
+
+
+
+def get_circuit(circuit):
+    '''
+    circuit: name of a built-in circuit, circuit string, or Circuit
+
+    Returns: Circuit
+    '''
+    if isinstance(circuit, Circuit):
+        return circuit
+    if circuit in circuits:
+        return circuits[circuit]
+    return compile_circuit(circuit)
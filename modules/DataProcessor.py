@@ -6,8 +6,55 @@ import pandas as pd
 
 if __name__ == '__main__':
     from DataStorage import ImpedanceSpectrum
+    from Distortion import DistortionMonitor
 else:
     from .DataStorage import ImpedanceSpectrum
+    from .Distortion import DistortionMonitor
+
+
+def excluded_bins(freqs, applied_freqs, harmonics=(2,3), other_freqs=()):
+    '''
+    Boolean mask over FFT bins which should not be used to estimate the
+    noise floor: the applied frequencies, their harmonics, and 60 Hz
+    mains harmonics.
+    
+    freqs: array of FFT bin frequencies, starting at the first non-DC bin
+    applied_freqs: array of applied frequencies
+    other_freqs: any additional frequencies to exclude (i.e. intermodulation)
+    '''
+    df  = freqs[0]
+    
+    applied = np.asarray(applied_freqs)
+    targets = [applied] + [n*applied for n in harmonics]
+    targets.append(np.arange(60, freqs[-1] + 60, 60))
+    targets.append(np.asarray(other_freqs, dtype=float))
+    targets = np.concatenate(targets)
+    
+    idxs = np.round(targets/df).astype(int) - 1
+    idxs = idxs[(idxs >= 0) & (idxs < len(freqs))]
+    
+    mask = np.zeros(len(freqs), dtype=bool)
+    mask[idxs] = True
+    return mask
+
+
+
+def noise_floor(ft, idxs, exclude, n_bins=8):
+    '''
+    Mean noise power in the n_bins usable bins closest to each of idxs.
+    
+    ft: complex FFT output
+    idxs: indices of applied frequencies in ft
+    exclude: boolean mask of bins which may not be used (see excluded_bins)
+    
+    Returns: np array of noise power, one value per index in idxs
+    '''
+    eligible = np.flatnonzero(~exclude)
+    pos      = np.searchsorted(eligible, idxs)
+    offsets  = np.arange(-(n_bins//2), n_bins - n_bins//2)
+    cols     = np.clip(pos[:,None] + offsets, 0, len(eligible) - 1)
+    
+    return np.mean(np.abs(ft[eligible[cols]])**2, axis=1)
 
 
 
@@ -24,6 +71,7 @@ class DataProcessor():
         self.buffer = ADCDataBuffer
                 
         self.wf    = None
+        self.distortion = DistortionMonitor()
         
 
     
@@ -41,39 +89,38 @@ class DataProcessor():
             if self.buffer.buffer:
                 data = self.buffer.get(1)
                 self.process(*data)
+                continue
             time.sleep(0.05)
     
                     
     
-    def make_spectrum(self, timestamp, freqs, Z, name):
+    def make_spectrum(self, timestamp, freqs, Z, name, snr=None, thd=None,
+                      Z_err=None):
         spectrum = ImpedanceSpectrum(
             freqs       = freqs,
             Z           = Z,
-            phase       = np.angle(Z, deg=True),
+            phase       = None,
             experiment  = self.master.experiment,
             timestamp   = timestamp,
-            name        = name
+            name        = name,
+            snr         = snr,
+            thd         = thd,
+            Z_err       = Z_err
             )
         if self.master.GUI.ref_correction_bool.get():
             spectrum.correct_Z(self.Z_factors, self.phase_factors)
-            
-        if (self.master.GUI.fit_bool.get() and
-            hasattr(self.master.GUI, 'fitter')):
-            initial_guess = None
-            try:
-                if len(self.master.experiment.spectra) > 0:
-                    initial_guess = self.master.experiment.spectra[-1].fit.copy()
-            except:
-                # Previous fit failed, use default guess
-                pass
-            fit = self.master.GUI.fitter.fit(spectrum, initial_guess)
-            
-            if type(fit) == dict:            
-                spectrum.fit = fit
-            
+        
+        fitting = (self.master.GUI.fit_bool.get() and
+                   hasattr(self.master.GUI, 'fitter'))
+        if fitting:
+            # Live estimate first, so it's there when the spectrum is plotted
+            self.master.FitQueue.track(spectrum)
             
         self.master.experiment.append_spectrum(spectrum)
-
+        
+        # Fit in the background, FitQueue fills in spectrum.fit when done
+        if fitting:
+            self.master.FitQueue.put(spectrum)
                 
                
     def process(self, timestamp, recording_params, volts1, volts2, name):
@@ -90,6 +137,11 @@ class DataProcessor():
         '''
         
         
+        # Save settings needed to replay archived raw frames
+        archive = self.master.experiment.raw_archive
+        if archive is not None and not archive.has_header():
+            archive.write_header(self.settings())
+        
         sample_rate = recording_params['sara']
         total_time  = recording_params['frame_time']
         i_range     = recording_params['i_range']
@@ -120,9 +172,19 @@ class DataProcessor():
         i = i[:cutoff_id]
         
         
-        freqs = sample_rate*np.fft.rfftfreq(len(v))[1:]
-        ft_v  =             np.fft.rfft(v)[1:]
-        ft_i  =            -np.fft.rfft(i)[1:]
+        periods = None
+        if self.master.GUI.period_avg_bool.get() and cnt > 1:
+            periods = self.period_ffts(v, i, cnt, sample_rate)
+        
+        if periods:
+            # Average of the individual periods
+            freqs, ft_v_k, ft_i_k = periods
+            ft_v  = ft_v_k.mean(axis=0)
+            ft_i  = ft_i_k.mean(axis=0)
+        else:
+            freqs = sample_rate*np.fft.rfftfreq(len(v))[1:]
+            ft_v  =             np.fft.rfft(v)[1:]
+            ft_i  =            -np.fft.rfft(i)[1:]
         
         
         freqs = freqs.round(3)
@@ -130,20 +192,85 @@ class DataProcessor():
         # Only keep applied frequencies
         idxs = [i for i, freq in enumerate(freqs) 
                 if freq in self.applied_freqs]
+        
+        # Standard error of Z from period-to-period scatter
+        Z_err = None
+        if periods:
+            Z_k   = ft_v_k[:,idxs]/ft_i_k[:,idxs]
+            Z_err = np.std(Z_k, axis=0, ddof=1)/np.sqrt(cnt)
+        
+        # Noise floor from the bins we didn't apply anything at
+        exclude = excluded_bins(freqs, self.applied_freqs,
+                                other_freqs = self.distortion.freqs)
+        noise_v = noise_floor(ft_v, idxs, exclude)
+        noise_i = noise_floor(ft_i, idxs, exclude)
+        
+        # Distortion of the current response
+        d_idxs = self.distortion.bins(freqs)
+        thd    = self.distortion.thd(ft_i, idxs, d_idxs,
+                                     noise_floor(ft_i, d_idxs, exclude))
+        self.distortion.check(thd)
                 
         freqs = freqs[idxs]
         ft_v  = ft_v[idxs]
         ft_i  = ft_i[idxs]
+        
+        # Relative variances of V and I add in Z = V/I
+        snr_v = np.abs(ft_v)**2/noise_v
+        snr_i = np.abs(ft_i)**2/noise_i
+        snr   = 1/(1/snr_v + 1/snr_i)
                 
-        self.make_spectrum(timestamp, freqs, ft_v/ft_i, name)
+        self.make_spectrum(timestamp, freqs, ft_v/ft_i, name, snr, thd, Z_err)
+        
+    
+    def period_ffts(self, v, i, cnt, sample_rate):
+        '''
+        Split v and i into cnt individual periods of the lowest applied
+        frequency and Fourier transform them all in one call.
+        
+        Returns: (freqs, ft_v, ft_i), ft_v and ft_i of shape (cnt, len(freqs)).
+                 None if the FFT bins of one period don't line up with
+                 the applied frequencies.
+        '''
+        n_per = len(v)//cnt
+        freqs = sample_rate*np.fft.rfftfreq(n_per)[1:]
+        
+        if not all(np.isin(self.applied_freqs, freqs.round(3))):
+            return None
+        
+        v = v[:cnt*n_per].reshape(cnt, n_per)
+        i = i[:cnt*n_per].reshape(cnt, n_per)
+        
+        ft_v =  np.fft.rfft(v, axis=1)[:,1:]
+        ft_i = -np.fft.rfft(i, axis=1)[:,1:]
+        return freqs, ft_v, ft_i
         
         
     
     
+    def settings(self):
+        '''
+        Processing settings, saved with raw frame archives so that they
+        can be reprocessed the same way (see Replay.py)
+        '''
+        wf = self.master.waveform
+        amps = wf.amps if wf.amps is not None else np.ones(len(wf.freqs))
+        return {
+            'freqs'           : np.asarray(wf.freqs).tolist(),
+            'phases'          : np.asarray(wf.phases).tolist(),
+            'amps'            : np.asarray(amps).tolist(),
+            'Z_factors'       : np.asarray(self.Z_factors).tolist(),
+            'phase_factors'   : np.asarray(self.phase_factors).tolist(),
+            'ref_correction'  : self.master.GUI.ref_correction_bool.get(),
+            'period_averaging': self.master.GUI.period_avg_bool.get(),
+            }
+    
+    
     def load_correction_factors(self):
         # Get applied frequencies and correction factors
         wf = self.master.waveform
         self.applied_freqs = wf.freqs
+        self.distortion.set_waveform(wf)
         
         wf_name = wf.name()
         wf_name = wf_name.replace('_opt', '')
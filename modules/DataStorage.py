@@ -1,67 +1,230 @@
 import time
 from datetime import datetime
 import os
+import queue
+import threading
+from collections.abc import Mapping
+from functools import lru_cache
 
 import numpy as np
-import pandas as pd
+
+if __name__ == '__main__':
+    from ExperimentIndex import ExperimentIndex, output_path
+    from Journal import JournalFile
+    from RawArchive import RawFrameArchive
+    from SpectrumHistory import SpectrumHistory
+    from SpectrumStore import (SpectrumStore, export_txt, write_row,
+                               write_spectrum_txt)
+else:
+    from .ExperimentIndex import ExperimentIndex, output_path
+    from .Journal import JournalFile
+    from .RawArchive import RawFrameArchive
+    from .SpectrumHistory import SpectrumHistory
+    from .SpectrumStore import (SpectrumStore, export_txt, write_row,
+                                write_spectrum_txt)
 
 
 class Experiment():
     
-    def __init__(self, master, name=None):
-        path = os.path.expanduser('~\Desktop\EIS Output')
-        path = os.path.join(path, datetime.now().strftime('%Y-%m-%d'))
-        if name:
-            path = os.path.join(path, name)
-        else:
-            path = os.path.join(path, 'autosave')
-            path = os.path.join(path, datetime.now().strftime('%H-%M-%S'))
+    index_db = None  # SQLite file to index experiments in as they are
+                     # written. None: default, False: don't index
+    
+    def __init__(self, master, name=None, path=None, window=1000):
+        '''
+        path: save to this folder instead of the default 
+              ~/Desktop/EIS Output/<date>/<name or autosave/time>
+        window: number of most recent spectra to keep in memory. Older
+                ones are read back from disk when accessed
+        '''
+        if not path:
+            path = os.path.join(output_path, datetime.now().strftime('%Y-%m-%d'))
+            if name:
+                path = os.path.join(path, name)
+            else:
+                path = os.path.join(path, 'autosave')
+                path = os.path.join(path, datetime.now().strftime('%H-%M-%S'))
         
         self.master    = master
         self.path      = path    # Save path
         self.time_file = os.path.join(path, '!times.txt')
         self.fits_file = os.path.join(path, '!fits.csv')
         self.meta_file = os.path.join(path, '!metadata.txt')
-        self.spectra   = []
+        self.snr_file  = os.path.join(path, '!snr.txt')
+        self.err_file  = os.path.join(path, '!Z_err.txt')
         self.i         = 0       # Counter for # of spectra
+        self.store     = SpectrumStore(os.path.join(path, 'spectra'))
+        self.first_row = len(self.store) # Rows saved by an earlier run
+        self.spectra   = SpectrumHistory(self.load_spectra, 
+                                         self.find_time, window)
+        self.save_txt  = False   # Also write legacy 000001.txt, ... files
         
         self.waveform = None
         self.correction_factors = None
+        self.raw_archive = None  # RawFrameArchive, if saving raw frames
+        self.writer      = ExperimentWriter(self)
+        self.times_journal = JournalFile(self.time_file)
+        self.fits_journal  = JournalFile(self.fits_file)
+        self.fsync_interval = 5  # s
+        self._last_sync     = time.time()
+        self._meta_written = False
+        self._index        = None   # ExperimentIndex, see _index_batch
+        self._index_ok     = True   # False if a batch failed to index
         
     
     def append_spectrum(self, spectrum):
-        os.makedirs(self.path, exist_ok=True)
+        '''
+        Add spectrum to this Experiment. experiment.spectra is updated
+        immediately, writing to disk happens in the background (see
+        ExperimentWriter)
+        '''
         self.spectra.append(spectrum)
         self.i = len(self.spectra)
-        spectrum.save()
-        self.write_time(spectrum)
+        spectrum.index = self.i
+        if not self._meta_written:
+            os.makedirs(self.path, exist_ok=True)
+            if not os.path.exists(self.meta_file):
+                self.write_metadata()
+            self._meta_written = True
+        self.writer.put('spectrum', spectrum)
         self.write_fits(spectrum)
-        if not os.path.exists(self.meta_file):
-            self.write_metadata()
         
     
-    def write_time(self, spectrum):
-        with open(self.time_file, 'a') as f:
-            f.write(f'{spectrum.timestamp}\n')
-            
-            
+    def load_spectra(self, start, stop):
+        '''
+        Read spectra start to stop (exclusive, 0-indexed) back from disk
+        
+        Returns: list of ImpedanceSpectrum
+        '''
+        if self.first_row + stop > len(self.store):
+            # Not written yet
+            self.writer.flush()
+        d = self.store.read(self.first_row + start, self.first_row + stop)
+        
+        spectra = []
+        for j in range(stop - start):
+            spectrum = ImpedanceSpectrum(
+                d['freqs'], d['Z'][j], None, self, d['t'][j], d['names'][j],
+                snr   = _or_none(d['snr'][j]),
+                thd   = _or_none(d['thd'][j]),
+                Z_err = _or_none(d['Z_err'][j]))
+            spectrum.index = start + j + 1
+            spectrum.fit   = d['fits'][j]
+            spectra.append(spectrum)
+        return spectra
+    
+    
+    def find_time(self, t):
+        # Position of the last spectrum on disk recorded at or before t
+        return max(self.store.find_time(t) - self.first_row, -1)
+    
+    
     def write_fits(self, spectrum):
         if spectrum.fit == None:
             return
-        if not os.path.exists(self.fits_file):
-            with open(self.fits_file, 'w') as f:
-                header_line = ','.join(key for key in spectrum.fit.keys())
-                header_line = 'file,time,' + header_line
-                f.write(header_line + '\n')
-        with open(self.fits_file, 'a') as f:
-            line = ','.join(str(val) for val in spectrum.fit.values())
-            name = spectrum.name
-            t    = spectrum.timestamp
-            if not name:
-                name = f'{self.i:06}.txt'
-                
-            line = f'{name},{t},' + line
-            f.write(line + '\n')
+        self.writer.put('fit', spectrum)
+        
+        
+    def _write_batch(self, items):
+        '''
+        Called from the ExperimentWriter thread. Writes a list of 
+        ('spectrum' or 'fit', spectrum) with one write per file
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        spectra = [spectrum for kind, spectrum in items if kind == 'spectrum']
+        fits    = [spectrum for kind, spectrum in items if kind == 'fit']
+        
+        # An error in one file mustn't stop the others from being written
+        try:
+            self._store_spectra(spectra)
+        except Exception as e:
+            print(f'Error saving spectra to {self.store.path}: {e}')
+        if self.save_txt:
+            try:
+                for spectrum in spectra:
+                    spectrum.save()
+                    self.write_snr(spectrum)
+                    self.write_errors(spectrum)
+            except Exception as e:
+                print(f'Error saving text files to {self.path}: {e}')
+        
+        # Force everything to disk every fsync_interval s
+        sync = time.time() - self._last_sync > self.fsync_interval
+        if sync:
+            self._last_sync = time.time()
+        
+        self.times_journal.write([f'{spectrum.timestamp}' 
+                                  for spectrum in spectra], sync=sync)
+        
+        if fits:
+            header = 'file,time,' + ','.join(key for key in fits[0].fit.keys())
+            self.fits_journal.write([self._fit_line(spectrum) 
+                                     for spectrum in fits], 
+                                    header=header, sync=sync)
+            try:
+                for spectrum in fits:
+                    self.store.append_fit(self.first_row + spectrum.index - 1, 
+                                          spectrum.fit)
+            except Exception as e:
+                print(f'Error saving fits to {self.store.path}: {e}')
+        self.store.flush(sync)
+        self._index_batch(spectra, fits)
+        
+    
+    def _store_spectra(self, spectra):
+        '''
+        Append spectra to the SpectrumStore. A folder which is reused
+        (e.g. 'reference') may hold a store of another waveform's 
+        frequencies. That one is moved aside and a new store started
+        '''
+        if not spectra:
+            return
+        stored = len(self.store) - self.first_row # By this run
+        if stored == 0 and not self.store.matches(spectra[0].freqs):
+            self.store.close()
+            old = self.store.rotate()
+            print(f'Frequencies changed, moved old spectra to {old}')
+            self.store     = SpectrumStore(os.path.join(self.path, 'spectra'))
+            self.first_row = 0
+        self.store.append_many(spectra)
+        
+    
+    def _index_batch(self, spectra, fits):
+        '''
+        Add a written batch to the experiment index, so runs can be found
+        while they are still going (or if they crash)
+        '''
+        if self.index_db is False or not self._index_ok:
+            return
+        try:
+            if self._index is None:
+                self._index = ExperimentIndex(self.index_db)
+            self._index.add_rows(
+                self.path, [spectrum.timestamp for spectrum in spectra],
+                [(self._fit_name(spectrum), spectrum.timestamp, 
+                  dict(spectrum.fit)) for spectrum in fits])
+        except Exception as e:
+            # close() re-indexes the whole folder instead
+            print(f'Could not index {self.path}: {e}')
+            self._index_ok = False
+            
+    
+    def write_snr(self, spectrum):
+        write_row(self.snr_file, spectrum.freqs, spectrum.snr)
+        
+    
+    def write_errors(self, spectrum):
+        write_row(self.err_file, spectrum.freqs, spectrum.Z_err)
+            
+            
+    def _fit_name(self, spectrum):
+        if spectrum.name:
+            return spectrum.name
+        # Fits may finish after later spectra have been appended
+        return f'{spectrum.index:06}.txt'
+    
+    def _fit_line(self, spectrum):
+        line = ','.join(str(val) for val in spectrum.fit.values())
+        return f'{self._fit_name(spectrum)},{spectrum.timestamp},' + line
             
     def write_metadata(self):
         with open(self.meta_file, 'w') as f:
@@ -85,28 +248,289 @@ class Experiment():
         self.waveform = Waveform
         
     
+    def enable_raw_archive(self):
+        '''
+        Also save raw oscilloscope frames, so spectra can be 
+        reprocessed later. ~80 kB per frame
+        '''
+        self.raw_archive = RawFrameArchive(os.path.join(self.path, 'raw'))
+        
+    
+    def close(self):
+        '''
+        Finish writing anything still pending to disk. Called when this
+        Experiment is replaced or the program exits.
+        '''
+        self.writer.close()
+        self._close_files()
+        if self.raw_archive is not None:
+            self.raw_archive.close()
+        
+        # Spectra and fits were indexed as they were written
+        if self.i > 0 and self.index_db is not False:
+            try:
+                index = self._index or ExperimentIndex(self.index_db)
+                if self._index_ok:
+                    index.finish(self.path)
+                else:
+                    index.add(self.path)
+            except Exception as e:
+                print(f'Could not index {self.path}: {e}')
+            
+    
+    def _close_files(self):
+        self.times_journal.close()
+        self.fits_journal.close()
+        self.store.close()
+        
+    
+    def export_txt(self):
+        '''
+        Write legacy per-spectrum text files for this experiment
+        '''
+        export_txt(self.path)
+        
     
+    
+def _or_none(values):
+    # Missing values are stored as NaN
+    if np.isnan(values).all():
+        return None
+    return values
+
+
+
+class ExperimentWriter():
+    '''
+    Writes an Experiment's spectra and fits to disk from a background 
+    thread, so slow disks don't hold up DataProcessor. Queued items are
+    written in batches, once batch_size have accumulated or the oldest is
+    interval s old, and on flush()/close(). Anything put after close()
+    (e.g. a fit which finished late) is written immediately.
+    '''
+    def __init__(self, experiment, batch_size=20, interval=2):
+        self.experiment = experiment
+        self.batch_size = batch_size
+        self.interval   = interval
+        
+        self._queue  = queue.Queue()
+        self._writer = None
+        self._lock   = threading.Lock()
+        self.closed  = False
+        
+    
+    def put(self, kind, spectrum):
+        with self._lock:
+            if self.closed:
+                # No writer thread to flush or join any more
+                self._write([(kind, spectrum)])
+                self.experiment._close_files()
+                return
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop,
+                                                daemon=True)
+                self._writer.start()
+        self._queue.put((kind, spectrum))
+        
+    
+    def flush(self):
+        '''
+        Wait until everything queued so far is on disk
+        '''
+        if self._writer is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+        
+    
+    def close(self):
+        with self._lock:
+            self.closed = True
+        self.flush()
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+            
+    
+    def _write(self, items):
+        try:
+            self.experiment._write_batch(items)
+        except Exception as e:
+            print(f'Error saving to {self.experiment.path}: {e}')
+    
+    
+    def _write_loop(self):
+        items = []
+        first = 0   # Time the oldest pending item was queued
+        while True:
+            timeout = self.interval
+            if items:
+                timeout = max(0, first + self.interval - time.time())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            
+            if isinstance(item, tuple):
+                if not items:
+                    first = time.time()
+                items.append(item)
+                if len(items) < self.batch_size:
+                    continue
+            
+            # Full batch, interval passed, flush, or close
+            if items:
+                self._write(items)
+                items = []
+            if isinstance(item, threading.Event):
+                item.set()
+            if item is None:
+                return
+    
+    
+    
+class FitVector(Mapping):
+    '''
+    Read-only dict-like view of one fit result, stored as a numpy record
+    with one float64 field per circuit element. Record dtypes are shared
+    between all fits with the same elements.
+    '''
+    __slots__ = ('record',)
+    
+    def __init__(self, fit):
+        keys = tuple(fit.keys())
+        self.record = np.array(tuple(fit.values()), dtype=_fit_dtype(keys))
+        
+    def __getitem__(self, key):
+        try:
+            return float(self.record[key])
+        except ValueError:
+            raise KeyError(key)
+    
+    def __iter__(self):
+        return iter(self.record.dtype.names)
+    
+    def __len__(self):
+        return len(self.record.dtype.names)
+    
+    def __repr__(self):
+        return repr(dict(self))
+    
+    def copy(self):
+        return dict(self)
+    
+    
+    
+@lru_cache(maxsize=None)
+def _fit_dtype(keys):
+    return np.dtype([(key, 'float64') for key in keys])
+
+
+
 class ImpedanceSpectrum():
+    '''
+    Z, snr and Z_err live either in this object or, once the spectrum is
+    appended to an Experiment, in a row of that Experiment's SpectrumBlock
+    (see SpectrumHistory.py). freqs is shared between all spectra of an
+    Experiment. Phase is computed from Z when accessed, unless it was 
+    given explicitly.
+    '''
+    __slots__ = ('freqs', '_Z', '_phase', '_snr', '_Z_err', '_fit', 
+                 '_block', '_row', 'experiment', 'timestamp', 'name', 
+                 'thd', 'index', 'track')
     
-    def __init__(self, freqs, Z, phase, experiment, timestamp, name=None):
-        self.timestamp = time.time()
+    def __init__(self, freqs, Z, phase, experiment, timestamp, name=None,
+                 snr=None, thd=None, Z_err=None):
+        self._block    = None       # SpectrumBlock holding Z, snr, Z_err
+        self._row      = None
         self.freqs     = freqs
         self.Z         = Z
-        self.phase     = phase
+        self._phase    = phase      # None: use angle of Z
         self.experiment= experiment # Associated Experiment object
         self.timestamp = timestamp
         self.name      = name
+        self.snr       = snr        # Signal/noise power ratio at each freq
+        self.thd       = thd        # Total harmonic distortion of current
+        self.Z_err     = Z_err      # Standard error of Z at each freq
+        self.index     = None       # Position in experiment, set on append
         self.fit       = None
+        self.track     = None       # Live parameter estimate, see Tracker.py
+    
+    def _get(self, column):
+        # detach() may run in another thread. It clears _block before
+        # _row, so read them the other way around
+        row, block = self._row, self._block
+        if block is not None and row is not None:
+            return block.get(column, row)
+        return getattr(self, f'_{column}')
+    
+    def _set(self, column, values):
+        if self._block is not None:
+            self._block.set(column, self._row, values)
+        else:
+            setattr(self, f'_{column}', values)
+    
+    Z     = property(lambda self: self._get('Z'),
+                     lambda self, Z: self._set('Z', Z))
+    snr   = property(lambda self: self._get('snr'),
+                     lambda self, snr: self._set('snr', snr))
+    Z_err = property(lambda self: self._get('Z_err'),
+                     lambda self, Z_err: self._set('Z_err', Z_err))
+    
+    @property
+    def phase(self):
+        if self._phase is not None:
+            return self._phase
+        return np.angle(self.Z, deg=True)
+    
+    @phase.setter
+    def phase(self, phase):
+        self._phase = phase
+    
+    @property
+    def fit(self):
+        return self._fit
+    
+    @fit.setter
+    def fit(self, fit):
+        # Numeric fit results are kept as a FitVector. Anything else (None,
+        # 0 for a failed fit) is kept as is
+        if isinstance(fit, Mapping) and not isinstance(fit, FitVector):
+            try:
+                fit = FitVector(fit)
+            except (TypeError, ValueError):
+                pass
+        self._fit = fit
+    
+    def detach(self):
+        '''
+        Copy Z, snr and Z_err out of the SpectrumBlock, before its row
+        is reused
+        '''
+        if self._block is None:
+            return
+        Z, snr, Z_err = self.Z.copy(), self.snr, self.Z_err
+        snr   = snr.copy() if snr is not None else None
+        Z_err = Z_err.copy() if Z_err is not None else None
+        # Copies first, so other threads reading Z never see None
+        self._Z, self._snr, self._Z_err = Z, snr, Z_err
+        self._block = None
+        self._row   = None
         
     def correct_Z(self, Z_factors, phase_factors):
         
         # |Z| correction is multiplicative
         Z = np.absolute(self.Z)
         Z /= Z_factors
+        if self.Z_err is not None:
+            self.Z_err = self.Z_err/Z_factors
         
         # Phase correction is additive
-        self.phase -= phase_factors
-        self.Z = Z * np.exp(1j*self.phase*np.pi/180)
+        phase = self.phase - phase_factors
+        self.Z = Z * np.exp(1j*phase*np.pi/180)
+        self._phase = None
         return
           
     def save(self, name=None):
@@ -115,7 +539,7 @@ class ImpedanceSpectrum():
         '''
         path = self.experiment.path
         os.makedirs(path, exist_ok=True)
-        i    = self.experiment.i
+        i    = self.index if self.index else self.experiment.i
         
         if self.name:
             name = self.name
@@ -123,32 +547,103 @@ class ImpedanceSpectrum():
             name = f'{i:06}.txt'
         
         save_path = os.path.join(path, name)
-        
-        d = pd.DataFrame(
-            {'f': self.freqs,
-             're': np.real(self.Z),
-             'im': np.imag(self.Z)}
-            )
-        d.to_csv(save_path, columns = ['f', 're', 'im'],
-                 header = ['<Frequency>', '<Re(Z)>', '<Im(Z)>'], 
-                 sep = '\t', index = False, encoding='ascii')
+        write_spectrum_txt(save_path, self.freqs, self.Z)
         # if 'autosave' not in save_path:
         #     print(f'Saved as {save_path}')
         
     
-    def average(self, spectra:list):
+    def average(self, spectra):
         '''
         Average this spectrum with several others.
         
         Returns a new ImpedanceSpectrum object
         '''
+        averager = SpectrumAverager()
+        averager.add(self)
+        for spectrum in spectra:
+            averager.add(spectrum)
+        return averager.spectrum()
         
-        Zs = np.array([np.array(spec.Z) for spec in spectra])
-        Z  = np.mean(Zs, axis=0)
+    
+    
+class SpectrumAverager():
+    '''
+    Running mean and variance of Z (Welford's algorithm) over spectra 
+    added one at a time, so no list of spectra needs to be kept.
+    
+    Z is averaged as a complex number and phase is taken from the mean Z,
+    which stays correct for phases near +-180 degrees.
+    '''
+    def __init__(self):
+        self.n     = 0
+        self.first = None   # First spectrum, gives freqs, time, name...
+        self.mean  = None
+        self.M2    = None   # Sum of |Z - mean|**2 at each frequency
+        self.snr   = None
         
-        phases = np.array([np.array(spec.phase) for spec in spectra])
-        phase  = np.mean(phases, axis=0)
+    
+    def add(self, spectrum):
+        Z = np.asarray(spectrum.Z)
+        if self.n == 0:
+            self.first = spectrum
+            self.mean  = np.zeros(len(Z), dtype=complex)
+            self.M2    = np.zeros(len(Z))
+            self.snr   = np.zeros(len(Z))
         
-        return ImpedanceSpectrum(self.freqs, Z, phase, self.experiment,
-                                 self.timestamp, self.name)
+        self.n    += 1
+        delta      = Z - self.mean
+        self.mean += delta/self.n
+        self.M2   += np.real(delta*np.conj(Z - self.mean))
         
+        # Noise powers of independent frames add, so SNRs do too
+        if self.snr is not None and spectrum.snr is not None:
+            self.snr = self.snr + spectrum.snr
+        else:
+            self.snr = None
+            
+    
+    @property
+    def variance(self):
+        '''
+        Sample variance of Z at each frequency, None for < 2 spectra
+        '''
+        if self.n < 2:
+            return None
+        return self.M2/(self.n - 1)
+    
+    
+    @property
+    def Z_err(self):
+        '''
+        Standard error of the mean Z at each frequency
+        '''
+        if self.n < 2:
+            return None
+        return np.sqrt(self.variance/self.n)
+    
+    
+    def spectrum(self):
+        '''
+        Returns: ImpedanceSpectrum of the mean Z, with Z_err
+        '''
+        if self.n == 0:
+            raise ValueError('No spectra to average')
+        first = self.first
+        return ImpedanceSpectrum(first.freqs, self.mean.copy(), None, 
+                                 first.experiment, first.timestamp, 
+                                 first.name, snr = self.snr, 
+                                 Z_err = self.Z_err)
+    
+    
+    
+def average(spectra):
+    '''
+    Average an iterable of ImpedanceSpectrum, e.g. experiment.spectra,
+    one spectrum at a time
+    
+    Returns: ImpedanceSpectrum
+    '''
+    averager = SpectrumAverager()
+    for spectrum in spectra:
+        averager.add(spectrum)
+    return averager.spectrum()
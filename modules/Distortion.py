@@ -0,0 +1,87 @@
+import numpy as np
+
+
+
+def distortion_freqs(freqs, harmonics=(2,3)):
+    '''
+    Frequencies at which a non-linear cell response to the applied
+    frequencies shows up: 2nd and 3rd harmonics of each frequency, and the
+    first-order intermodulation products f1+f2 and |f1-f2| of every pair.
+
+    Frequencies which coincide with an applied frequency are left out, since
+    those bins are dominated by the linear response.
+
+    freqs: array of applied frequencies
+
+    Returns: sorted np array of frequencies
+    '''
+    freqs = np.asarray(freqs, dtype=float)
+
+    harm = [n*freqs for n in harmonics]
+
+    # All pairs f1 > f2
+    f1, f2 = np.meshgrid(freqs, freqs)
+    pairs  = np.triu_indices(len(freqs), k=1)
+    inter  = [(f1 + f2)[pairs], np.abs(f1 - f2)[pairs]]
+
+    d = np.unique(np.concatenate(harm + inter).round(3))
+    d = d[~np.isin(d, freqs.round(3))]
+    return d[d > 0]
+
+
+
+class DistortionMonitor():
+    '''
+    Checks each frame for harmonic and intermodulation distortion at the
+    frequencies predicted from the active Waveform. A total harmonic
+    distortion (THD) above max_thd means the cell is being driven outside
+    its linear regime and Vpp should be lowered.
+    '''
+    def __init__(self, max_thd=0.02):
+        self.max_thd = max_thd
+        self.freqs   = np.array([])
+
+        self._flagged = False
+
+
+    def set_waveform(self, Waveform):
+        self.freqs = distortion_freqs(Waveform.freqs)
+
+
+    def bins(self, freqs):
+        '''
+        Indices of the distortion frequencies in an FFT output with
+        frequency axis freqs (first non-DC bin first)
+        '''
+        df = freqs[0]
+        idxs = np.round(self.freqs/df).astype(int) - 1
+        return idxs[(idxs >= 0) & (idxs < len(freqs))]
+
+
+    def thd(self, ft, idxs, d_idxs, noise):
+        '''
+        Ratio of total distortion amplitude to total applied amplitude.
+
+        ft: complex FFT output (typically the current channel)
+        idxs: indices of applied frequencies in ft
+        d_idxs: indices of distortion frequencies in ft (from bins())
+        noise: noise power at each of d_idxs, subtracted so that a linear
+               but noisy cell reads ~0
+        '''
+        signal = np.sum(np.abs(ft[idxs])**2)
+        power  = np.sum(np.abs(ft[d_idxs])**2 - noise)
+        return np.sqrt(max(power, 0)/signal)
+
+
+    def check(self, thd):
+        '''
+        Returns True if thd is too high. Prints a warning the first time
+        in a row that a frame is flagged
+        '''
+        flagged = thd > self.max_thd
+        if flagged and not self._flagged:
+            print(f'Warning: {100*thd:0.1f}% harmonic distortion. '+
+                  'Consider lowering the amplitude.')
+        self._flagged = flagged
+        return flagged
+
@@ -0,0 +1,364 @@
+'''
+SQLite index of all experiments under the output folder, for finding runs
+by waveform, circuit, sensor, date or fit results without opening every
+folder.
+
+Experiments are indexed as their spectra and fits are written (see
+Experiment._write_batch), and updated once more when they are closed.
+Older folders are added with update(), which skips folders that haven't
+changed since they were last indexed.
+
+Usage: python modules/ExperimentIndex.py [output folder]
+'''
+import os
+import csv
+import json
+import sqlite3
+
+import numpy as np
+
+if __name__ == '__main__':
+    from funcs import sensor_conc
+else:
+    from .funcs import sensor_conc
+
+
+output_path = os.path.join(os.path.expanduser('~'), 'Desktop', 'EIS Output')
+
+schema = '''
+CREATE TABLE IF NOT EXISTS experiments (
+    id          INTEGER PRIMARY KEY,
+    path        TEXT UNIQUE,
+    date        TEXT,
+    name        TEXT,
+    waveform    TEXT,
+    circuit     TEXT,
+    sensors     TEXT,
+    n_spectra   INTEGER,
+    t_start     REAL,
+    t_end       REAL,
+    metadata    TEXT,
+    mtime       REAL
+);
+CREATE TABLE IF NOT EXISTS fits (
+    experiment  INTEGER REFERENCES experiments(id) ON DELETE CASCADE,
+    file        TEXT,
+    time        REAL,
+    sensor      TEXT,
+    concentration TEXT,
+    param       TEXT,
+    value       REAL
+);
+CREATE INDEX IF NOT EXISTS fits_experiment ON fits(experiment);
+CREATE INDEX IF NOT EXISTS fits_param ON fits(param, sensor);
+'''
+
+# Files whose modification means an experiment needs re-indexing
+watched = ['!metadata.txt', '!times.txt', '!fits.csv',
+           os.path.join('spectra', 't.bin')]
+
+
+
+def read_metadata(path):
+    '''
+    Returns: dict of "Key: value" lines in !metadata.txt
+    '''
+    meta = {}
+    file = os.path.join(path, '!metadata.txt')
+    if not os.path.exists(file):
+        return meta
+    with open(file, 'r') as f:
+        for line in f:
+            if ': ' in line:
+                key, val = line.split(': ', 1)
+                meta[key.strip()] = val.strip()
+    return meta
+
+
+
+def read_times(path):
+    '''
+    Returns: array of spectrum timestamps, from the spectrum store or
+             !times.txt
+    '''
+    t_file = os.path.join(path, 'spectra', 't.bin')
+    if os.path.exists(t_file):
+        return np.fromfile(t_file, dtype='float64')
+    file = os.path.join(path, '!times.txt')
+    if os.path.exists(file):
+        with open(file, 'rb') as f:
+            return np.array(f.read().split(), dtype=float)
+    return np.array([])
+
+
+
+def read_fits(path):
+    '''
+    Returns: list of (file, time, {param: value}) from !fits.csv
+    '''
+    file = os.path.join(path, '!fits.csv')
+    if not os.path.exists(file):
+        return []
+    fits = []
+    with open(file, 'r') as f:
+        for row in csv.DictReader(f):
+            name = row.pop('file')
+            t    = row.pop('time')
+            try:
+                fits.append((name, float(t),
+                             {key: float(val) for key, val in row.items()}))
+            except (TypeError, ValueError):
+                # Incomplete row
+                continue
+    return fits
+
+
+
+def is_experiment(path):
+    return any(os.path.exists(os.path.join(path, file)) for file in watched)
+
+
+
+def folder_mtime(path):
+    return max([os.path.getmtime(os.path.join(path, file)) for file in watched
+                if os.path.exists(os.path.join(path, file))] + [0])
+
+
+
+class ExperimentIndex():
+    '''
+    db: path of the SQLite database, default !index.sqlite in the output
+        folder
+    '''
+    def __init__(self, db=None):
+        self.db = db or os.path.join(output_path, '!index.sqlite')
+        os.makedirs(os.path.dirname(os.path.abspath(self.db)), exist_ok=True)
+        with self.connect() as con:
+            con.executescript(schema)
+
+
+    def connect(self):
+        # New connection per call, so any thread can use the index
+        con = sqlite3.connect(self.db, timeout=10)
+        con.row_factory = sqlite3.Row
+        con.execute('PRAGMA foreign_keys = ON')
+        return con
+
+
+    def add(self, path):
+        '''
+        (Re-)index one experiment folder
+        '''
+        path  = os.path.abspath(path)
+        meta  = read_metadata(path)
+        times = read_times(path)
+        fits  = read_fits(path)
+
+        names   = [name for name, _, _ in fits]
+        sensors = sorted({s for s, _ in map(sensor_conc, names) if s})
+        parent, name = os.path.split(path)
+        date = os.path.basename(parent)
+        if date == 'autosave':
+            date = os.path.basename(os.path.dirname(parent))
+
+        con = self.connect()
+        with con:
+            con.execute('DELETE FROM experiments WHERE path = ?', (path,))
+            cur = con.execute(
+                '''INSERT INTO experiments (path, date, name, waveform,
+                       circuit, sensors, n_spectra, t_start, t_end,
+                       metadata, mtime)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (path, date, name, meta.get('Waveform'),
+                 meta.get('Fit circuit'), ','.join(sensors), len(times),
+                 float(times[0]) if len(times) else None,
+                 float(times[-1]) if len(times) else None,
+                 json.dumps(meta), folder_mtime(path)))
+            expt_id = cur.lastrowid
+            con.executemany(
+                '''INSERT INTO fits VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                ((expt_id, file, t, *sensor_conc(file), param, value)
+                 for file, t, fit in fits for param, value in fit.items()))
+        con.close()
+
+
+    def add_rows(self, path, times, fits):
+        '''
+        Add newly written spectra and fits of an experiment, without
+        re-reading its folder. The experiment is added if it isn't in the
+        index yet.
+
+        times: list of timestamps of the new spectra
+        fits: list of (file, time, {param: value}) of the new fits
+        '''
+        path = os.path.abspath(path)
+        con  = self.connect()
+        with con:
+            row = con.execute('''SELECT id, sensors FROM experiments 
+                                 WHERE path = ?''', (path,)).fetchone()
+            if row is None:
+                meta = read_metadata(path)
+                parent, name = os.path.split(path)
+                date = os.path.basename(parent)
+                if date == 'autosave':
+                    date = os.path.basename(os.path.dirname(parent))
+                cur = con.execute(
+                    '''INSERT INTO experiments (path, date, name, waveform,
+                           circuit, sensors, n_spectra, metadata)
+                       VALUES (?, ?, ?, ?, ?, '', 0, ?)''',
+                    (path, date, name, meta.get('Waveform'),
+                     meta.get('Fit circuit'), json.dumps(meta)))
+                expt_id, sensors = cur.lastrowid, ''
+            else:
+                expt_id, sensors = row['id'], row['sensors']
+
+            sensors = set(filter(None, (sensors or '').split(',')))
+            sensors.update(s for s, _ in (sensor_conc(file) 
+                                          for file, _, _ in fits) if s)
+            if times:
+                con.execute(
+                    '''UPDATE experiments SET 
+                           n_spectra = n_spectra + ?,
+                           t_start   = COALESCE(t_start, ?),
+                           t_end     = ?
+                       WHERE id = ?''',
+                    (len(times), float(times[0]), float(times[-1]), expt_id))
+            con.execute('UPDATE experiments SET sensors = ? WHERE id = ?',
+                        (','.join(sorted(sensors)), expt_id))
+            con.executemany(
+                '''INSERT INTO fits VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                ((expt_id, file, t, *sensor_conc(file), param, value)
+                 for file, t, fit in fits for param, value in fit.items()))
+        con.close()
+
+
+    def finish(self, path):
+        '''
+        Final update of an experiment indexed with add_rows(): its metadata,
+        and the folder time, so update() doesn't index it again
+        '''
+        path = os.path.abspath(path)
+        meta = read_metadata(path)
+        con  = self.connect()
+        with con:
+            con.execute(
+                '''UPDATE experiments SET waveform = ?, circuit = ?,
+                       metadata = ?, mtime = ?
+                   WHERE path = ?''',
+                (meta.get('Waveform'), meta.get('Fit circuit'),
+                 json.dumps(meta), folder_mtime(path), path))
+        con.close()
+
+
+    def update(self, root=None):
+        '''
+        Index all experiment folders under root (default: the output
+        folder) which are new or changed since they were last indexed
+
+        Returns: number of folders (re-)indexed
+        '''
+        root = root or output_path
+        con  = self.connect()
+        known = {row['path']: row['mtime'] for row in
+                 con.execute('SELECT path, mtime FROM experiments')}
+        con.close()
+
+        n = 0
+        for dirpath, dirnames, _ in os.walk(root):
+            if not is_experiment(dirpath):
+                continue
+            # Don't descend into an experiment's own subfolders
+            dirnames[:] = [d for d in dirnames if d not in ('raw', 'parquet')
+                           and not d.startswith('spectra')]
+            path = os.path.abspath(dirpath)
+            if known.get(path) == folder_mtime(path):
+                continue
+            self.add(path)
+            n += 1
+        return n
+
+
+    def experiments(self, waveform=None, circuit=None, sensor=None,
+                    name=None, date_from=None, date_to=None):
+        '''
+        Find experiments. All arguments are optional, name and waveform
+        match substrings, dates are 'YYYY-MM-DD'
+
+        Returns: list of dicts
+        '''
+        where, args = [], []
+        for column, val, op in [('waveform', waveform, 'LIKE'),
+                                ('name', name, 'LIKE'),
+                                ('circuit', circuit, '='),
+                                ('date', date_from, '>='),
+                                ('date', date_to, '<=')]:
+            if val is not None:
+                where.append(f'{column} {op} ?')
+                args.append(f'%{val}%' if op == 'LIKE' else val)
+        if sensor is not None:
+            where.append("(',' || sensors || ',') LIKE ?")
+            args.append(f'%,{sensor},%')
+
+        sql = 'SELECT * FROM experiments'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return self.query(sql + ' ORDER BY date, t_start', args)
+
+
+    def fits(self, params=None, sensor=None, concentration=None,
+             experiment=None, t_from=None, t_to=None):
+        '''
+        Fit parameter values, one row per (spectrum, parameter)
+
+        params: list of parameter names, e.g. ['Rct', 'Cads']
+        experiment: experiment id or folder path
+
+        Returns: list of dicts with experiment path, file, time, sensor,
+                 concentration, param, value
+        '''
+        where, args = [], []
+        if params is not None:
+            where.append(f'param IN ({",".join("?"*len(params))})')
+            args.extend(params)
+        for column, val, op in [('sensor', sensor, '='),
+                                ('concentration', concentration, '='),
+                                ('time', t_from, '>='),
+                                ('time', t_to, '<=')]:
+            if val is not None:
+                where.append(f'fits.{column} {op} ?')
+                args.append(val)
+        if experiment is not None:
+            if isinstance(experiment, str):
+                where.append('experiments.path = ?')
+                experiment = os.path.abspath(experiment)
+            else:
+                where.append('experiments.id = ?')
+            args.append(experiment)
+
+        sql = '''SELECT experiments.path, fits.file, fits.time, fits.sensor,
+                        fits.concentration, fits.param, fits.value
+                 FROM fits JOIN experiments ON fits.experiment = experiments.id'''
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return self.query(sql + ' ORDER BY fits.time', args)
+
+
+    def query(self, sql, args=()):
+        '''
+        Run any SQL query on the index
+
+        Returns: list of dicts
+        '''
+        con = self.connect()
+        rows = [dict(row) for row in con.execute(sql, args)]
+        con.close()
+        return rows
+
+
+
+
+if __name__ == '__main__':
+    import sys
+    root  = sys.argv[1] if len(sys.argv) > 1 else output_path
+    index = ExperimentIndex(os.path.join(root, '!index.sqlite'))
+    print(f'Indexed {index.update(root)} experiments in {root}')
@@ -0,0 +1,168 @@
+'''
+Persistent cache of fit results, so re-fitting the same spectrum with the
+same circuit and initial guess (re-running fit_all.py, reloading an
+experiment) doesn't redo the fit.
+
+Results are keyed by a hash of the frequencies, Z, circuit, initial guess,
+free parameters, point weights and fitting engine version, and stored in an SQLite file
+in the output folder. When the cache is full, the least recently used
+results are dropped. Failed fits are not cached.
+'''
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+
+from .ExperimentIndex import output_path
+from .Circuits import get_circuit
+from .LEVM.LEVM import LEVM_exe
+from . import CNLS, Circuits
+
+
+schema = '''
+CREATE TABLE IF NOT EXISTS fits (
+    key     TEXT PRIMARY KEY,
+    fit     TEXT,
+    used    REAL
+);
+CREATE INDEX IF NOT EXISTS fits_used ON fits(used);
+'''
+
+# Files which change the fit results of each engine if they change
+engine_files = {'CNLS': [CNLS.__file__, Circuits.__file__],
+                'LEVM': [LEVM_exe]}
+
+
+
+def engine_version(engine):
+    '''
+    Returns: str identifying the current version of the engine's code
+    '''
+    return ';'.join(f'{os.path.getsize(file)}:{os.path.getmtime(file)}'
+                    for file in engine_files.get(engine, [])
+                    if os.path.exists(file))
+
+
+
+def fit_key(freqs, Z, guess, circuit, free, engine, weights=None):
+    '''
+    Returns: hex digest of everything that determines the fit result
+    '''
+    circuit = get_circuit(circuit)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.ascontiguousarray(freqs, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(Z, dtype=np.complex128).tobytes())
+    h.update(json.dumps([circuit.string, engine, engine_version(engine),
+                         [(name, float(guess[name]), bool(free[name]))
+                          for name in circuit.params]]).encode())
+    if weights is not None:
+        h.update(np.ascontiguousarray(weights, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+
+class FitCache():
+    '''
+    db: path of the SQLite file, default !fitcache.sqlite in the output
+        folder
+    max_entries: number of fits to keep. Least recently used fits are
+                 dropped beyond this
+
+    hits, misses: number of lookups which did/ didn't find a cached fit
+    '''
+    def __init__(self, db=None, max_entries=200000):
+        self.db = db or os.path.join(output_path, '!fitcache.sqlite')
+        self.max_entries = max_entries
+        self.hits   = 0
+        self.misses = 0
+        self._puts  = 0
+        self._lock  = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.db)), exist_ok=True)
+        # One connection shared between threads, guarded by _lock
+        self.con = sqlite3.connect(self.db, timeout=10,
+                                   check_same_thread=False)
+        self.con.execute('PRAGMA journal_mode = WAL')
+        self.con.execute('PRAGMA synchronous = NORMAL')
+        with self.con:
+            self.con.executescript(schema)
+
+
+    def get(self, key):
+        '''
+        Returns: cached fit dict, or None
+        '''
+        return self.get_many([key])[0]
+
+
+    def get_many(self, keys):
+        '''
+        Returns: list of cached fit dicts, None for keys not in the cache
+        '''
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                rows  = self.con.execute(
+                    f'SELECT key, fit FROM fits WHERE key IN '
+                    f'({",".join("?"*len(chunk))})', chunk)
+                found.update((key, json.loads(fit)) for key, fit in rows)
+            if found:
+                with self.con:
+                    self.con.executemany('UPDATE fits SET used = ? WHERE key = ?',
+                                         ((time.time(), key) for key in found))
+            self.hits   += len(found)
+            self.misses += len(keys) - len(found)
+        return [found.get(key) for key in keys]
+
+
+    def put(self, key, fit):
+        self.put_many([key], [fit])
+
+
+    def put_many(self, keys, fits):
+        '''
+        Save fits, skipping failed fits (anything but a dict)
+        '''
+        rows = [(key, json.dumps(fit), time.time())
+                for key, fit in zip(keys, fits) if type(fit) == dict]
+        if not rows:
+            return
+        with self._lock:
+            with self.con:
+                self.con.executemany(
+                    'INSERT OR REPLACE INTO fits VALUES (?, ?, ?)', rows)
+            self._puts += len(rows)
+            if self._puts >= 1000 or len(rows) > 1:
+                self._puts = 0
+                self._evict()
+
+
+    def _evict(self):
+        n = self.con.execute('SELECT COUNT(*) FROM fits').fetchone()[0]
+        if n <= self.max_entries:
+            return
+        with self.con:
+            self.con.execute('''DELETE FROM fits WHERE key IN
+                                (SELECT key FROM fits ORDER BY used LIMIT ?)''',
+                             (n - self.max_entries,))
+
+
+    def clear(self):
+        with self._lock:
+            with self.con:
+                self.con.execute('DELETE FROM fits')
+
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate  = self.hits/total if total else 0
+        return f'Fit cache: {self.hits} hits, {self.misses} misses ({rate:.0%} hits)'
+
+
+    def close(self):
+        self.con.close()
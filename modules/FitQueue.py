@@ -0,0 +1,159 @@
+import time
+import threading
+from collections import deque
+
+from .WarmStart import WarmStart
+from .Tracker import ParameterTracker
+from .Circuits import get_circuit
+from .Fitter import point_snr
+from .funcs import sensor_conc
+
+
+
+class FitQueue():
+    '''
+    Fits spectra to the chosen equivalent circuit in its own thread, so
+    that a slow (or timed out) fit doesn't hold up processing of the
+    following frames in DataProcessor.
+
+    DataProcessor appends and saves each spectrum immediately, then puts
+    it here. When its fit finishes, it is written to spectrum.fit and
+    to the Experiment's !fits.csv.
+
+    Spectra are fit one at a time in the order they were recorded, so
+    each fit can be warm-started from the previous spectra's fits (see
+    WarmStart.py). Multiplexed sensors are warm-started separately.
+
+    Before a spectrum is queued, track() updates a live estimate of its
+    sensor's parameters (see Tracker.py), which is much faster than a fit
+    and is corrected by each fit when it finishes.
+    '''
+    def __init__(self, master):
+        self.willStop = False
+        self.master = master
+        self.master.register(self)
+
+        self.queue = deque()
+        self._lock   = threading.Lock() # Held while a spectrum is fit
+        self.stopped = False
+        self.experiment  = None # Experiment of the last spectrum fit
+        self.warm_starts = {}   # {sensor: WarmStart}
+        
+        self.tracked_experiment = None
+        self.trackers = {}      # {sensor: ParameterTracker}
+
+
+    def run(self):
+        # Stops between fits, anything left is fit by drain()
+        while not (self.stopped or self.master.STOP):
+            if not self._fit_next():
+                time.sleep(0.05)
+
+
+    def stop(self):
+        self.stopped = True
+    
+    
+    def drain(self, experiment=None):
+        '''
+        Fit everything in the queue, or only experiment's spectra, in this
+        thread. Call before closing an experiment, so its fits are saved
+        '''
+        while self._fit_next(experiment):
+            pass
+
+
+    def _fit_next(self, experiment=None):
+        '''
+        Fit the oldest queued spectrum (of experiment, if given)
+
+        Returns: False if there was nothing to fit
+        '''
+        with self._lock:
+            for spectrum in list(self.queue):
+                if experiment is None or spectrum.experiment is experiment:
+                    break
+            else:
+                return False
+            # Leave it in the queue until it's done so pending() sees it
+            self.fit(spectrum)
+            self.queue.remove(spectrum)
+            return True
+
+
+    def put(self, spectrum):
+        self.queue.append(spectrum)
+
+
+    def track(self, spectrum):
+        '''
+        Update the live parameter estimate of spectrum's sensor, in the
+        calling thread, and save it to spectrum.track
+        '''
+        fitter = getattr(self.master.GUI, 'fitter', None)
+        if fitter is None or not fitter.circuit:
+            return
+
+        if spectrum.experiment is not self.tracked_experiment:
+            self.tracked_experiment = spectrum.experiment
+            self.trackers = {}
+        sensor  = sensor_conc(spectrum.name or '')[0]
+        tracker = self.trackers.get(sensor)
+        if tracker is None or tracker.circuit is not get_circuit(fitter.circuit):
+            # Same precedence as Fitter.fit. Tables are built by the first
+            # fit, in the FitQueue thread, not here in DataProcessor's
+            guess = fitter.guesses
+            if not guess and fitter.use_table():
+                guess = fitter.table_guess(spectrum, build=False)
+            if not guess:
+                return
+            tracker = ParameterTracker(fitter.circuit, guess)
+            self.trackers[sensor] = tracker
+
+        # Leave out noisy points, like Fitter.fit
+        freqs, Z = spectrum.freqs, spectrum.Z
+        snr = point_snr(spectrum)
+        if snr is not None:
+            keep = snr >= fitter.min_snr
+            if sum(keep) >= len(tracker.names):
+                freqs, Z = freqs[keep], Z[keep]
+
+        spectrum.track = tracker.update(spectrum.timestamp, freqs, Z)
+
+
+    def pending(self, spectrum):
+        '''
+        True if spectrum is waiting to be fit or is being fit now
+        '''
+        return spectrum in self.queue
+
+
+    def fit(self, spectrum):
+        if not hasattr(self.master.GUI, 'fitter'):
+            # Fitting was turned off after this spectrum was recorded
+            return
+
+        if spectrum.experiment is not self.experiment:
+            self.experiment  = spectrum.experiment
+            self.warm_starts = {}
+        sensor = sensor_conc(spectrum.name or '')[0]
+        if sensor not in self.warm_starts:
+            self.warm_starts[sensor] = WarmStart()
+        warm_start = self.warm_starts[sensor]
+
+        # Extrapolated from previous fits, None for the default guess
+        initial_guess = warm_start.guess(spectrum.timestamp)
+
+        info = {}
+        fit  = self.master.GUI.fitter.fit(spectrum, initial_guess, info=info)
+        warm_start.update(spectrum.timestamp, fit, info)
+
+        if type(fit) == dict:
+            spectrum.fit = fit
+            spectrum.experiment.write_fits(spectrum)
+            
+            tracker = self.trackers.get(sensor)
+            if tracker and spectrum.experiment is self.tracked_experiment:
+                tracker.correct(spectrum.timestamp, fit)
+
+
@@ -3,84 +3,168 @@ from tkinter import *
 from tkinter.ttk import *
 from PIL import Image
 import os
+import time
 
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
-from .LEVM.LEVM import LEVM_fit
+from .LEVM.LEVM import LEVM_fit, LEVM_circuits
+from .CNLS import CNLS_fit, CNLS_fit_batch
+from .Circuits import circuits, get_circuit
+from .FitCache import FitCache, fit_key
+from .GuessTable import get_table
 
 
-allowed_circuits = ('RRC', 'Sensor')
+# Circuits in the GUI dropdown, see Circuits.py to add more
+allowed_circuits = tuple(circuits)
 
-# Default parameter initial guesses/ free or not (bool)
-circuit_params = {
-    'RRC': {
-        'R1': (100, 1),
-        'R2': (1000, 1),
-        'C1': (1e-6, 1),
-        '_img': 'etc/RRC.png'     
-        },
-    'Sensor': {
-        'Rs': (500, 1),
-        'Rct': (30000, 1),
-        'Cdl': (1e-7, 1),
-        'n_dl': (1, 0),
-        'Cads': (5e-7, 1),
-        'n_ads': (0.84, 0),
-        '_img': 'etc/Sensor.png'
-        }
-        
-    }
+# Fitting engines. LEVM.exe only runs on Windows
+fit_engines = ('LEVM', 'CNLS')
 
 
 def predict_circuit(circuit, frequencies, params):
     '''
     Return estimated Z(w) at the given frequencies for the chosen circuit.
     
-    circuit: str, one of "RRC" or "Sensor"
+    circuit: str, name of a built-in circuit or a circuit string
     frequencies: list or array of frequencies
     params: dict of {circuit element: value}
     
-    Returns: np array of shape (len(frequencies), 1)
+    Returns: np array of shape (len(frequencies),)
     '''
-    
-    def CPE(f, params):
-        '''
-        Params:
-            Q: CPE value
-            n: CPE exponent (0 < n < 1)
-        '''
-        w = 2*np.pi*f
-        Q = params['Q']
-        n = params['n']
-        return 1/(Q*(w*1j)**n)
-    
-    if circuit not in allowed_circuits:
-        return
-    
-    if circuit == 'RRC':
-        w = 2*np.pi*frequencies
-        R1 = params['R1']
-        R2 = params['R2']
-        C = params['C1']
-        Z_C = 1/(1j*w*C)
-        return R1 + (R2*Z_C)/(Z_C + R2)
-    
-    if circuit == 'Sensor':
-        R1 = params['Rs']
-        R2 = params['Rct']
-        Q1 = params['Cdl']
-        n1 = params['n_dl']
-        Q2 = params['Cads']
-        n2 = params['n_ads']
-        Ca = CPE(frequencies, {'Q':Q2, 'n':n2})
-        Cdl = CPE(frequencies, {'Q':Q1, 'n':n1})
-        Z = R1 + 1/(1/Cdl + 1/(R2+Ca))
-        return Z
+    return get_circuit(circuit).Z(frequencies, params)
         
 
 
+def point_snr(spectrum):
+    '''
+    Signal/noise power ratio of each point of spectrum. Uses the standard
+    error of Z if it was measured (period averaging), which also catches
+    outliers with a lot of scatter, otherwise the noise floor SNR.
+    
+    Returns: np array, or None if neither is known
+    '''
+    Z_err = getattr(spectrum, 'Z_err', None)
+    snr   = getattr(spectrum, 'snr', None)
+    if Z_err is not None:
+        return np.abs(spectrum.Z)**2/np.asarray(Z_err)**2
+    if snr is not None:
+        return np.asarray(snr, dtype=float)
+    return None
+
+
+
+def fit_weights(spectrum):
+    '''
+    Relative least-squares weights for each point of spectrum. The 
+    variance of Z/|Z| goes as 1/SNR.
+    
+    Returns: np array normalized to mean 1, or None if SNR is unknown
+    '''
+    snr = point_snr(spectrum)
+    if snr is None:
+        return None
+    return snr/np.mean(snr)
+
+
+
+def fit_spectrum(freqs, Z, guess, circuit, free, engine='CNLS', timeout=0.4,
+                 cache=None, info=None, weights=None):
+    '''
+    Fit one spectrum with the chosen engine. Uses CNLS for circuits LEVM
+    doesn't have.
+    
+    guess: dict of {element: value}
+    free: dict of {element: bool}
+    engine: 'LEVM' or 'CNLS'
+    weights: optional array of relative weights for each point, see 
+             fit_weights(). Only CNLS uses them
+    cache: FitCache to look the fit up in first, and save it to
+    info: optional dict, filled in with 'time' taken by the fit, and
+          'n_iter' for CNLS fits
+    
+    Returns: dict of fit parameters, or 0 if the fit failed
+    '''
+    if circuit not in LEVM_circuits:
+        engine = 'CNLS'
+    if engine != 'CNLS':
+        weights = None
+    
+    start = time.perf_counter()
+    if cache is not None:
+        key  = fit_key(freqs, Z, guess, circuit, free, engine, weights)
+        fits = cache.get(key)
+        if fits:
+            if info is not None:
+                info.update(time=time.perf_counter() - start, cached=True)
+            return fits
+    
+    if engine == 'CNLS':
+        fits = CNLS_fit(freqs, Z, guess, circuit, free, weights=weights,
+                        info=info)
+    else:
+        fits = LEVM_fit(freqs, Z, guess, circuit, free, timeout=timeout)
+    if info is not None:
+        info['time'] = time.perf_counter() - start
+    
+    if cache is not None:
+        cache.put(key, fits)
+    return fits
+
+
+
+def fit_spectra(freqs, Z, guess, circuit, free, cache=None):
+    '''
+    Fit many spectra with the same frequencies at once with CNLS. Only
+    spectra which aren't in cache are fit.
+    
+    Z: (n_spectra, n_freqs) array of impedances
+    guess: dict of {element: value}. Values can also be arrays of one 
+           guess per spectrum
+    
+    Returns: list of fit dicts, 0 for any fit that failed
+    '''
+    if cache is None:
+        return CNLS_fit_batch(freqs, Z, guess, circuit, free)
+    
+    guesses = {elem: np.broadcast_to(np.asarray(val, dtype=float), len(Z))
+               for elem, val in guess.items()}
+    keys = [fit_key(freqs, z, {elem: val[i] for elem, val in guesses.items()},
+                    circuit, free, 'CNLS') 
+            for i, z in enumerate(Z)]
+    fits = cache.get_many(keys)
+    todo = [i for i, fit in enumerate(fits) if fit is None]
+    if todo:
+        new = CNLS_fit_batch(freqs, np.asarray(Z)[todo], 
+                             {elem: val[todo] for elem, val in guesses.items()},
+                             circuit, free)
+        cache.put_many([keys[i] for i in todo], new)
+        for i, fit in zip(todo, new):
+            fits[i] = fit
+    return fits
+
+
+
+def table_guesses(table, Z, guess):
+    '''
+    Initial guesses for many spectra from a GuessTable. Uses the value in
+    guess for any lookup that failed
+    
+    Z: (n_spectra, n_freqs) array of impedances
+    guess: dict of {element: value}
+    
+    Returns: dict of {element: array of one guess per spectrum}
+    '''
+    rows = table.lookup(np.atleast_2d(Z))
+    guesses = {}
+    for elem, default in guess.items():
+        vals = np.array([row[elem] for row in rows], dtype=float)
+        guesses[elem] = np.where(np.isfinite(vals) & (vals > 0), vals, default)
+    return guesses
+
+
+
 class Fitter():
     def __init__(self, master):
         self.willStop = False
@@ -88,7 +172,21 @@ class Fitter():
         self.master.register(self)
         
         self.guesses = None # dict of element: (guess, free)
+        self.bools   = {}   # dict of element: free
         self.circuit = None
+        self.min_snr = 10   # Points below this SNR are left out of fits
+        self.engine  = 'LEVM' if os.name == 'nt' else 'CNLS'
+        
+        # Initial guesses from simulated spectra (see table_guess()).
+        # None: only while self.guesses isn't set, True: for every fit
+        # without a warm start, False: never
+        self.use_guess_table = None
+        
+        try:
+            self.cache = FitCache()
+        except Exception as e:
+            print(f'Fit cache unavailable: {e}')
+            self.cache = None
     
     def parameter_window(self, selection=None):
         '''
@@ -99,9 +197,8 @@ class Fitter():
             
         self.circuit = selection
         
-        params = circuit_params[selection].copy()
-        imgfile = params['_img']
-        params.pop('_img')
+        circuit = get_circuit(selection)
+        params  = circuit.defaults.copy()
                 
         window = Toplevel()
         window.title('Fitting options')
@@ -115,8 +212,12 @@ class Fitter():
         ax = fig.add_subplot(111)
         canvas = FigureCanvasTkAgg(fig, master=imframe)
         canvas.get_tk_widget().grid(row=0, column=0)
-        img = np.asarray(Image.open(imgfile))
-        ax.imshow(img)
+        if circuit.img:
+            img = np.asarray(Image.open(circuit.img))
+            ax.imshow(img)
+        else:
+            ax.text(0.5, 0.5, circuit.string, ha='center', va='center',
+                    wrap=True)
         ax.set_xticks([])
         ax.set_yticks([])
         for sp in ['left', 'right', 'top', 'bottom']:
@@ -150,6 +251,12 @@ class Fitter():
             cancelled = True
             window.destroy()
         
+        Label(frame, text='Fit with').grid(row=row, column=0, sticky=(W,E))
+        engine_var = StringVar(value=self.engine)
+        OptionMenu(frame, engine_var, self.engine, *fit_engines).grid(
+            row=row, column=1, columnspan=2, sticky=(W,E))
+        row += 1
+        
         Button(frame, text='Done', command=window.destroy).grid(
             row=row, column=0, columnspan=3)
         Button(frame, text='Cancel', command=_cancel).grid(
@@ -161,6 +268,7 @@ class Fitter():
             del cancelled
             return 0
             
+        self.engine  = engine_var.get()
         self.guesses = params.copy()
         self.bools = {}
         for (elem, value, boolean) in zip(elems, values, bools):
@@ -174,7 +282,7 @@ class Fitter():
         return self.guesses
     
     
-    def fit(self, spectrum, initial_guess=None):
+    def fit(self, spectrum, initial_guess=None, engine=None, info=None):
         '''
         Fit spectrum to the chosen equivalent circuit. Use initial guess if
         give, otherwise uses previously-set initial guess by paramete_window().
@@ -182,31 +290,126 @@ class Fitter():
         parameter_window().
         
         spectrum: ImpedanceSpectrum object
-        initial_guess: dictionary of {element: (value, free)} 
+        initial_guess: dictionary of {element: (value, free)}. If None,
+                       uses self.guesses, or the lookup table (see 
+                       use_guess_table)
+        engine: 'LEVM' or 'CNLS', default self.engine
+        info: optional dict, filled in with fit time and iterations, see
+              fit_spectrum()
+        '''
+        if not initial_guess and self.use_table():
+            initial_guess = self.table_guess(spectrum)
+        
+        guess, free = self._initial_guess(initial_guess)
+        circuit = self.circuit
+        
+        # Set values for fitting
+        
+        freqs   = np.asarray(spectrum.freqs)
+        Z       = np.asarray(spectrum.Z)
+        weights = fit_weights(spectrum)
+        
+        # LEVM takes no per-point weights, so drop points with ~0 weight.
+        # CNLS also gets the SNR weights of the rest
+        snr = point_snr(spectrum)
+        if snr is not None:
+            keep = snr >= self.min_snr
+            if sum(keep) >= len(guess):
+                freqs   = freqs[keep]
+                Z       = Z[keep]
+                weights = weights[keep]/np.mean(weights[keep])
+        
+        # Run fitting subroutine
+        return fit_spectrum(freqs, Z, guess, circuit, free, 
+                            engine or self.engine, cache=self.cache, 
+                            info=info, weights=weights)
+    
+    
+    def fit_batch(self, freqs, Z, initial_guess=None):
         '''
+        Fit many spectra which have the same frequencies all at once, 
+        using the CNLS engine. Much faster than calling fit() on each.
+        Spectra already in the fit cache aren't refit.
         
-        # Get initial guess
+        freqs: array of frequencies
+        Z: (n_spectra, n_freqs) array of impedances
+        initial_guess: dictionary of {element: (value, free)}, used for
+                       every spectrum. If None, uses self.guesses, or the
+                       lookup table (see use_guess_table)
         
+        Returns: list of fit dicts, 0 for any fit that failed
+        '''
+        guess, free = self._initial_guess(initial_guess)
+        if not initial_guess and self.use_table():
+            try:
+                table = get_table(self.circuit, freqs, 
+                                  {elem: (guess[elem], free[elem]) 
+                                   for elem in guess})
+                guess = table_guesses(table, Z, guess)
+            except Exception as e:
+                print(f'Guess table lookup failed: {e}')
+        return fit_spectra(freqs, Z, guess, self.circuit, free, self.cache)
+    
+    
+    def use_table(self):
+        '''
+        True if fits without an initial guess are guessed from the lookup
+        table, see use_guess_table
+        '''
+        if not self.circuit or self.use_guess_table is False:
+            return False
+        return bool(self.use_guess_table or not self.guesses)
+    
+    
+    def table_guess(self, spectrum, build=True):
+        '''
+        Initial guess for spectrum from the table of simulated spectra at
+        its frequencies (see GuessTable.py). Fixed elements keep their
+        values in self.guesses, or the circuit's defaults.
+        
+        build: bool, if False only use a table which is already built
+        
+        Returns: dictionary of {element: (value, free)}, or None if the
+                 lookup failed
+        '''
+        defaults = self.guesses or get_circuit(self.circuit).defaults
+        try:
+            table  = get_table(self.circuit, spectrum.freqs, defaults, build)
+            if table is None:
+                return None
+            values = table.lookup(spectrum.Z)
+        except Exception as e:
+            print(f'Guess table lookup failed: {e}')
+            return None
+        if not np.all(np.isfinite(list(values.values()))):
+            return None
+        return {elem: (values[elem], free) 
+                for elem, (_, free) in defaults.items()}
+    
+    
+    def _initial_guess(self, initial_guess=None):
+        '''
+        Returns: dicts of {element: value} and {element: free}
+        '''
         if not initial_guess:
-            initial_guess = self.guesses if self.guesses else self.parameter_window()
+            if self.guesses:
+                initial_guess = self.guesses
+            elif self.use_table():
+                # Fixed elements at their defaults, the table guesses the rest
+                initial_guess = dict(get_circuit(self.circuit).defaults)
+            else:
+                initial_guess = self.parameter_window()
         
         for elem, val in initial_guess.items():
             if not type(val) == tuple:
-                initial_guess[elem] = (val, self.bools[elem])
+                free = self.bools.get(elem)
+                if free is None:
+                    free = get_circuit(self.circuit).defaults[elem][1]
+                initial_guess[elem] = (val, free)
         
-        circuit = self.circuit
-        
-        # Set values for fitting
-        
-        freqs = spectrum.freqs
-        Z     = spectrum.Z
         guess = {elem: value for elem, (value, boolean) in initial_guess.items()}
         free  = {elem: boolean for elem, (value, boolean) in initial_guess.items()}
-        
-        # Run fitting subroutine
-        fits = LEVM_fit(freqs, Z, guess, circuit, free, timeout=0.4)
-        return fits
-
+        return guess, free
 
 
 
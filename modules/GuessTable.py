@@ -0,0 +1,169 @@
+'''
+Lookup tables of simulated spectra, for initial guesses that don't need
+a fit (or a person) to find them.
+
+A table holds the spectra of one circuit at one set of frequencies (i.e.
+one waveform), simulated over a log-spaced grid of its free parameters.
+Each spectrum is reduced to a few principal components of its log|Z| and
+phase. An incoming spectrum's guess is the (geometric) mean of the grid
+points of its nearest neighbours in that space, which takes a few hundred microseconds.
+Averaging a few neighbours keeps guesses away from the edges of the grid
+along parameters the spectrum hardly depends on, which fits can run off
+from.
+
+Tables are built the first time they're needed and saved to
+!guess_tables in the output folder, so each circuit/ waveform is only
+built once.
+'''
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from .Circuits import get_circuit
+from .ExperimentIndex import output_path
+
+
+table_path = os.path.join(output_path, '!guess_tables')
+
+# Tables kept in memory, {key: GuessTable}
+tables = {}
+
+
+
+def features(Z):
+    '''
+    Returns: (n_spectra, 2*n_freqs) array of log|Z| and phase
+    '''
+    Z = np.atleast_2d(Z)
+    return np.concatenate([np.log(np.abs(Z)), np.angle(Z)], axis=1)
+
+
+
+class GuessTable():
+    '''
+    circuit: str, name of a built-in circuit or a circuit string
+    freqs: array of frequencies
+    guess: dict of {param: (value, free)}, default the circuit's
+           defaults. Free parameters are gridded from value/span to
+           value*span, the others are held at value
+    n_points: grid points per free parameter. Lowered for circuits with
+              many free parameters, to keep at most max_rows spectra
+    n_components: number of principal components to match spectra on
+    n_neighbours: number of nearest spectra to average the guess over
+    '''
+    def __init__(self, circuit, freqs, guess=None, n_points=12, span=30,
+                 n_components=8, n_neighbours=8, max_rows=50000):
+        circuit    = get_circuit(circuit)
+        self.freqs = np.asarray(freqs, dtype=float)
+        self.guess = dict(guess or circuit.defaults)
+        self.names = circuit.params
+        self.free  = [name for name in self.names if self.guess[name][1]]
+        self.n_neighbours = n_neighbours
+
+        n_points = max(2, min(n_points,
+                              int(max_rows**(1/max(len(self.free), 1)))))
+        axes = [np.geomspace(self.guess[name][0]/span,
+                             self.guess[name][0]*span, n_points)
+                for name in self.free]
+        grid = np.stack([a.ravel() for a in np.meshgrid(*axes, indexing='ij')],
+                        axis=1)
+        self.params = grid
+
+        p = {name: self.guess[name][0] for name in self.names}
+        p.update({name: grid[:,i:i+1] for i, name in enumerate(self.free)})
+        X = features(circuit.Z(self.freqs, p))
+
+        # Standardize, then keep the main principal components
+        self.mean = X.mean(axis=0)
+        self.std  = X.std(axis=0) + 1e-9
+        X = (X - self.mean)/self.std
+        _, _, Vt = np.linalg.svd(X[::max(1, len(X)//5000)],
+                                 full_matrices=False)
+        self.basis  = Vt[:n_components].T
+        self.coords = (X @ self.basis).astype(np.float32)
+        self.norms  = np.einsum('ij,ij->i', self.coords, self.coords)
+
+
+    def lookup(self, Z):
+        '''
+        Z: one spectrum, or (n_spectra, n_freqs) array of spectra, at
+           the table's frequencies
+
+        Returns: dict of {param: guess}, or a list of them for many spectra
+        '''
+        q = (((features(Z) - self.mean)/self.std) @ self.basis).astype(np.float32)
+        # |c - q|^2 without the |q|^2 term, which is the same for every c
+        d = self.norms[None,:] - 2*q @ self.coords.T
+        k = min(self.n_neighbours, d.shape[1])
+        idx = np.argpartition(d, k-1, axis=1)[:,:k]
+        rows = np.exp(np.log(self.params[idx]).mean(axis=1))
+
+        guesses = []
+        for row in rows:
+            guess = {name: self.guess[name][0] for name in self.names}
+            guess.update(zip(self.free, row.tolist()))
+            guesses.append(guess)
+        return guesses if np.ndim(Z) == 2 else guesses[0]
+
+
+    def save(self, file):
+        np.savez(file, freqs=self.freqs, params=self.params, mean=self.mean,
+                 std=self.std, basis=self.basis, coords=self.coords,
+                 meta=json.dumps({'names': self.names, 'free': self.free,
+                                  'guess': self.guess, 
+                                  'n_neighbours': self.n_neighbours}))
+
+
+    @classmethod
+    def load(cls, file):
+        table = cls.__new__(cls)
+        with np.load(file) as d:
+            for key in ('freqs', 'params', 'mean', 'std', 'basis', 'coords'):
+                setattr(table, key, d[key])
+            meta = json.loads(str(d['meta']))
+        table.names = tuple(meta['names'])
+        table.free  = meta['free']
+        table.n_neighbours = meta['n_neighbours']
+        table.guess = {key: tuple(val) for key, val in meta['guess'].items()}
+        table.norms = np.einsum('ij,ij->i', table.coords, table.coords)
+        return table
+
+
+
+def get_table(circuit, freqs, guess=None, build=True):
+    '''
+    build: bool, if False only return a table already in memory
+
+    Returns: GuessTable for circuit at freqs. Loaded from disk, or built
+             and saved if there isn't one yet. None if build=False and
+             it isn't in memory
+    '''
+    circuit = get_circuit(circuit)
+    guess   = dict(guess or circuit.defaults)
+    h = hashlib.blake2b(digest_size=12)
+    h.update(np.ascontiguousarray(freqs, dtype=np.float64).tobytes())
+    h.update(json.dumps([circuit.string,
+                         [(name, float(guess[name][0]), bool(guess[name][1]))
+                          for name in circuit.params]]).encode())
+    key = h.hexdigest()
+
+    if key in tables or not build:
+        return tables.get(key)
+
+    file = os.path.join(table_path, f'{key}.npz')
+    if os.path.exists(file):
+        try:
+            tables[key] = GuessTable.load(file)
+            return tables[key]
+        except Exception as e:
+            print(f'Error loading guess table {file}: {e}')
+
+    tables[key] = GuessTable(circuit, freqs, guess)
+    try:
+        os.makedirs(table_path, exist_ok=True)
+        tables[key].save(file)
+    except OSError as e:
+        print(f'Could not save guess table: {e}')
+    return tables[key]
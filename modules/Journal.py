@@ -0,0 +1,93 @@
+import os
+
+
+
+def repair(path, keep=None):
+    '''
+    Truncate a text file after its last complete (newline-terminated)
+    line, e.g. after the program died halfway through writing a line.
+
+    keep: int, also cut the file after this many lines
+
+    Returns: number of bytes removed
+    '''
+    if not os.path.exists(path):
+        return 0
+    size = os.path.getsize(path)
+
+    with open(path, 'rb+') as f:
+        if keep is not None:
+            end = 0
+            for _ in range(keep):
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break
+                end = f.tell()
+        else:
+            # Search backwards for the last newline
+            end = size
+            while end > 0:
+                start = max(0, end - 65536)
+                f.seek(start)
+                i = f.read(end - start).rfind(b'\n')
+                if i >= 0:
+                    end = start + i + 1
+                    break
+                end = start
+        if end < size:
+            f.truncate(end)
+    return size - end
+
+
+
+class JournalFile():
+    '''
+    Append-only text file of one record per line (!times.txt, !fits.csv)
+    which stays open while the experiment runs.
+
+    Each call to write() goes to the OS as a single write of complete
+    lines, and is forced to disk with fsync() when sync=True. If the
+    program died partway through a line, the partial line is removed
+    when the file is next opened.
+    '''
+    def __init__(self, path):
+        self.path  = path
+        self._file = None
+
+
+    def _open(self):
+        removed = repair(self.path)
+        if removed:
+            print(f'Removed incomplete last line from {self.path}')
+        self._file = open(self.path, 'ab', buffering=0)
+
+
+    def _write(self, text):
+        data = memoryview(text.encode())
+        while data:
+            # Raw writes can return early, retry the rest
+            data = data[self._file.write(data):]
+
+
+    def write(self, lines, header=None, sync=False):
+        '''
+        lines: list of str, without newlines
+        header: str, written first if the file is new or empty
+        sync: bool, fsync after writing
+        '''
+        if not lines:
+            return
+        if self._file is None:
+            self._open()
+        if header is not None and self._file.tell() == 0:
+            lines = [header] + lines
+        self._write(''.join(line + '\n' for line in lines))
+        if sync:
+            os.fsync(self._file.fileno())
+
+
+    def close(self):
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
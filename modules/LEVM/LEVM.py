@@ -1,6 +1,12 @@
 import sys
 import os
+import shutil
+import tempfile
+import threading
 import subprocess
+from contextlib import contextmanager
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import math
 '''
@@ -10,8 +16,22 @@ Main function to call for LEVM fitting:
 LEVM_fit(freqs, Z, guess, circuit, free_params):
     returns fits: dict of best-fit parameters
 
+LEVM_fit_many(freqs, Zs, guess, circuit, free_params):
+    fits many spectra in parallel, returns list of fit dicts
+
+Each LEVM run gets its own scratch directory for INFL and OUTIN, so any
+number of fits can run at once from different threads. Wrap many fits in
+`with scratch_dirs():` to reuse the directories between fits.
+
 '''
 
+LEVM_exe = os.path.join(os.path.dirname(os.path.realpath(__file__)), 
+                        'LEVM.exe')
+
+
+# Circuits which assign_params knows how to map to LEVM parameters
+LEVM_circuits = ('Sensor', 'Randles_uelec', 'RRC', 'RRQ')
+
 
 def assign_params(circuit, guess, free):
         # Write initial guesses to select parameters
@@ -90,7 +110,8 @@ def assign_params(circuit, guess, free):
 #####                      LEVM INPUT PARAMS                             #####
 ##############################################################################
 
-# Input fields defined in LEVM Manual, p. 69
+# Input fields defined in LEVM Manual, p. 69. Defaults for every fit, 
+# write_input_file() fills in FUN and M for each fit on a copy.
 # !! PRESERVE FIELD LENGTHS WHEN CHANGING VALUES !!
 inputs = {
     'IOPT':'   0',
@@ -232,15 +253,13 @@ def write_comment_line(file, comment):
     
     
 
-def write_input_params(file):
+def write_input_params(file, settings):
     '''
     Write lines 2 and 3 containing fit settings.
     
-    Settings defined in global inputs dict
+    settings: dict of input fields, see inputs
     '''
     
-    global inputs
-    
     line2 = ''
     line3 = ''
     
@@ -253,10 +272,10 @@ def write_input_params(file):
                'MODE', 'ICP', 'IPRINT', 'IGACC', 'ATEMP']
 
     for key in line2_order:
-        line2 = line2 + inputs[key]
+        line2 = line2 + settings[key]
     
     for key in line3_order:
-        line3 = line3 + inputs[key]
+        line3 = line3 + settings[key]
     
     with open(file, 'a') as f:
         f.write(line2 + '\n')
@@ -349,20 +368,17 @@ def write_input_file(file, freqs, Z, params, comment=' '):
         Max 80 characters.
 
     '''
-    
-    global inputs
-    
-    
     p, binary_line, function = params_to_LEVM_format(params)
-            
-    inputs['FUN'] = function    
-    inputs['M'] = str(len(freqs)).rjust(5, ' ')
+    
+    settings = dict(inputs)
+    settings['FUN'] = function    
+    settings['M'] = str(len(freqs)).rjust(5, ' ')
     
     for i in p:
         p[i] = float_to_string(p[i], 8)
         
     write_comment_line(file, comment)
-    write_input_params(file)
+    write_input_params(file, settings)
     write_initial_params(file, p)
     write_binary_line(file, binary_line)
     write_Z_data(file, freqs, Z)
@@ -374,13 +390,95 @@ def write_input_file(file, freqs, Z, params, comment=' '):
 #####                      RUN LEVM                                      #####
 ##############################################################################
 
-def run_LEVM(LEVM_path, timeout):
+class ScratchPool():
+    '''
+    Pool of scratch directories for LEVM to run in. Each fit takes a 
+    directory for itself while it runs, then gives it back for reuse.
+    Directories are made as they are needed, and deleted by cleanup().
+    '''
+    def __init__(self):
+        self.free   = Queue()
+        self.dirs   = []
+        self.lock   = threading.Lock()
+        self.closed = False
+    
+    
+    def _make(self):
+        path = tempfile.mkdtemp(prefix='LEVM_')
+        with self.lock:
+            self.dirs.append(path)
+        return path
+    
+    
+    def get(self):
+        try:
+            return self.free.get_nowait()
+        except Empty:
+            return self._make()
+    
+    
+    def put(self, path):
+        with self.lock:
+            if not self.closed:
+                self.free.put(path)
+                return
+            # Given back after cleanup()
+            self.dirs.remove(path)
+        shutil.rmtree(path, ignore_errors=True)
+    
+    
+    def cleanup(self):
+        '''
+        Delete all directories. Ones still in use are deleted when they
+        are given back
+        '''
+        with self.lock:
+            self.closed = True
+            while True:
+                try:
+                    path = self.free.get_nowait()
+                except Empty:
+                    break
+                self.dirs.remove(path)
+                shutil.rmtree(path, ignore_errors=True)
+
+
+# ScratchPool shared by fits inside scratch_dirs(), None outside
+scratch = None
+scratch_lock = threading.Lock()
+
+
+
+@contextmanager
+def scratch_dirs():
+    '''
+    Reuse scratch directories between the LEVM fits run inside this
+    block (from any thread), and delete them at the end of it. Fits
+    outside any block make and delete a directory each.
+    '''
+    global scratch
+    with scratch_lock:
+        owner = scratch is None
+        if owner:
+            scratch = ScratchPool()
+        pool = scratch
+    try:
+        yield pool
+    finally:
+        if owner:
+            with scratch_lock:
+                scratch = None
+            pool.cleanup()
+
+
+
+def run_LEVM(LEVM_path, timeout, cwd):
+    '''
+    Run LEVM using subproccess.run(), in directory cwd
     '''
-    Run LEVM using subproccess.run()
-    # '''
     try:
-        subprocess.run(['ls', '-l'],
-    stdout = subprocess.DEVNULL, executable=LEVM_path, timeout=timeout)
+        subprocess.run([LEVM_path], cwd=cwd, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, timeout=timeout)
         return 0
     except subprocess.TimeoutExpired:
         print('LEVM.exe timed out')
@@ -470,28 +568,58 @@ def LEVM_fit(freqs, Z, guess, circuit, free_params,
             Fitted parameters
 
     '''
-    # Determine location of LEVM.py
-    original_path = os.getcwd()
-    path = os.path.realpath(__file__)[:-7]
-    
-    os.chdir(path)
-    LEVM_path = 'LEVM.exe'
-    
     params = assign_params(circuit, guess, free_params)
     
-    write_input_file('INFL', freqs, Z, params, comment)
-    timedout = run_LEVM(LEVM_path, timeout = timeout)
-    if timedout == 1:
-        os.chdir(original_path)
-        return 0
-    fits = extract_params('OUTIN', params)
-    
-    os.chdir(original_path)
+    pool = scratch
+    path = pool.get() if pool else tempfile.mkdtemp(prefix='LEVM_')
+    try:
+        infl  = os.path.join(path, 'INFL')
+        outin = os.path.join(path, 'OUTIN')
+        if os.path.exists(outin):
+            # Left over from the last fit in this directory
+            os.remove(outin)
+        
+        write_input_file(infl, freqs, Z, params, comment)
+        timedout = run_LEVM(LEVM_exe, timeout, cwd=path)
+        if timedout == 1 or not os.path.exists(outin):
+            return 0
+        fits = extract_params(outin, params)
+    finally:
+        if pool:
+            pool.put(path)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
     
     return fits
 
 
 
+def LEVM_fit_many(freqs, Zs, guess, circuit, free_params, timeout = 2,
+                  n_workers = None):
+    '''
+    Fit many spectra with LEVM, running one LEVM.exe per core at once.
+    
+    freqs: array of frequencies
+    Zs: list of Z arrays, one per spectrum
+    guess, circuit, free_params: same as LEVM_fit. guess can also be a
+        list of one guess dict per spectrum
+    n_workers: int, fits to run at once. Default number of cores
+    
+    Returns: list of fit dicts (0 for fits that failed), in the same 
+             order as Zs
+    '''
+    n_workers = n_workers or os.cpu_count() or 1
+    guesses   = guess if isinstance(guess, (list, tuple)) else [guess]*len(Zs)
+    
+    # Threads are enough, the fitting happens in the LEVM.exe processes
+    with scratch_dirs(), ThreadPoolExecutor(n_workers) as pool:
+        futures = [pool.submit(LEVM_fit, freqs, Z, g, circuit, free_params,
+                               timeout)
+                   for Z, g in zip(Zs, guesses)]
+        return [future.result() for future in futures]
+
+
+
 
 
 
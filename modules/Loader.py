@@ -0,0 +1,120 @@
+import os
+import json
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+if __name__ == '__main__':
+    from SpectrumStore import load_store
+else:
+    from .SpectrumStore import load_store
+
+
+
+Spectra = namedtuple('Spectra', ['times', 'freqs', 'Z', 'names'])
+
+cache_name = '!spectra_cache.npz'
+
+
+
+def load_experiment(folder, use_cache=True, n_threads=8):
+    '''
+    Load all spectra in an experiment folder at once.
+
+    Reads the experiment's spectrum store if it has one. Otherwise parses
+    every legacy spectrum .txt file (000001.txt, s0_10uM.txt, ...) in a
+    thread pool, and saves the result to !spectra_cache.npz in the folder.
+    The cache is used as long as no spectrum file has been added, removed
+    or modified since.
+
+    folder: experiment folder
+    use_cache: bool, read and write the cache file
+    n_threads: int, number of files to read at once
+
+    Returns: Spectra namedtuple of
+        times: (n_spectra,) array, NaN if unknown
+        freqs: (n_freqs,) array
+        Z: (n_spectra, n_freqs) complex array
+        names: list of n_spectra file names
+    '''
+    store = os.path.join(folder, 'spectra')
+    if os.path.exists(os.path.join(store, 'header.json')):
+        d = load_store(store)
+        names = [name or f'{i+1:06}.txt' for i, name in enumerate(d['names'])]
+        return Spectra(d['t'], d['freqs'], d['Z'], names)
+
+    # Single directory scan, file sizes and modification times included
+    entries   = sorted((e for e in os.scandir(folder)
+                        if e.is_file() and e.name.endswith('.txt') and
+                        not e.name.startswith('!')),
+                       key = lambda e: e.name)
+    signature = json.dumps([(e.name, e.stat().st_size, e.stat().st_mtime_ns)
+                            for e in entries])
+    cache     = os.path.join(folder, cache_name)
+
+    if use_cache and os.path.exists(cache):
+        with np.load(cache) as d:
+            if str(d['signature']) == signature:
+                return Spectra(d['times'], d['freqs'], d['Z'],
+                               d['names'].tolist())
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        parsed = list(pool.map(read_spectrum_txt,
+                               [e.path for e in entries]))
+
+    names, spectra = [], []
+    freqs = None
+    for entry, spectrum in zip(entries, parsed):
+        if spectrum is None:
+            # Not a spectrum file
+            continue
+        f, Z = spectrum
+        if freqs is None:
+            freqs = f
+        if not np.array_equal(f, freqs):
+            print(f'{entry.name} has different frequencies, skipping')
+            continue
+        names.append(entry.name)
+        spectra.append(Z)
+
+    if freqs is None:
+        freqs = np.array([])
+    Z     = np.array(spectra, dtype=complex).reshape(len(names), len(freqs))
+    times = read_times(folder, len(names))
+
+    if use_cache:
+        np.savez(cache, times=times, freqs=freqs, Z=Z, names=np.array(names),
+                 signature=np.array(signature))
+    return Spectra(times, freqs, Z, names)
+
+
+
+def read_spectrum_txt(file):
+    '''
+    Parse one tab-separated <Frequency> <Re(Z)> <Im(Z)> file.
+
+    Returns: (freqs, Z), or None if file is not a spectrum
+    '''
+    with open(file, 'rb') as f:
+        header = f.readline()
+        if not header.startswith(b'<Frequency>'):
+            return None
+        data = f.read()
+
+    # Splitting all the text at once is much faster than np.loadtxt
+    vals = np.array(data.split(), dtype=float).reshape(-1, 3)
+    return vals[:,0], vals[:,1] + 1j*vals[:,2]
+
+
+
+def read_times(folder, n):
+    # Timestamps from !times.txt, if there is one for every spectrum
+    file = os.path.join(folder, '!times.txt')
+    if os.path.exists(file):
+        with open(file, 'rb') as f:
+            times = np.array(f.read().split(), dtype=float)
+        if len(times) == n:
+            return times
+    return np.full(n, np.nan)
+
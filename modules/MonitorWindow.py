@@ -9,10 +9,10 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
 from .funcs import nearest
-from .Fitter import circuit_params
+from .Circuits import get_circuit
 
 
-plot_options = ['|Z|', 'Phase', 'Parameter', 'k']
+plot_options = ['|Z|', 'Phase', 'Parameter', 'k', 'k (live)', 'THD']
 xmaxes = [30, 60, 120, 300, 600, 1200] + [1800*i for i in range(1,200)]
 
 
@@ -24,6 +24,8 @@ class MonitorWindow:
         phase at freq. f
         EEC parameter
         k_et
+        k_et (live), from FitQueue's parameter tracker, +- 1 std. dev.
+        harmonic distortion
     '''
     def __init__(self, master, root, sensor_names=list):
         self.master = master
@@ -33,8 +35,10 @@ class MonitorWindow:
         self.expt = self.master.experiment
         self.last_spectrum = None
         self.last_selection= None
+        self.n_plotted     = 0     # Number of expt.spectra plotted so far
         self.xdata = {sensor_name:[] for sensor_name in sensor_names}
         self.ydata = {sensor_name:[] for sensor_name in sensor_names}
+        self.yerr  = {sensor_name:[] for sensor_name in sensor_names}
         
         self.window = Toplevel()
         self.window.protocol('WM_DELETE_WINDOW', self._on_closing)
@@ -98,6 +102,7 @@ class MonitorWindow:
     def generate_axes(self):
         self.axes = {}
         self.lns  = {}
+        self.err_lns = {}
         keys = list(self.xdata.keys())
         n_axes = len(keys)
         if n_axes == 1:
@@ -141,7 +146,7 @@ class MonitorWindow:
             self.root.after(100, self.update)
             return
         
-        if self.expt.spectra[-1] != self.last_spectrum:
+        if len(self.expt.spectra) > self.n_plotted:
             st = time.time()
             self.update_plot()
             t = time.time() - st
@@ -153,16 +158,30 @@ class MonitorWindow:
         
     def update_plot(self):
         '''
-        Append newest data point to plot. 
+        Append newest data points to plot. Fits finish in the background, 
+        so if we are plotting a fit parameter, stop at the first spectrum
+        which is still waiting on its fit.
         '''
-        spec      = self.expt.spectra[-1]
         selection = self.display_selection.get()
         option    = self.display_option.get()
-        ax_key = [key for key in self.xdata.keys() if spec.name.startswith(key)][0]
-        self.process_spectrum(ax_key, spec, selection, option)
-        self.update_axlim(ax_key) # Check if we need to adjust the axis limits
-        self._draw_blit(ax_key)
-        self.last_spectrum = spec
+        needs_fit = selection in ('Parameter', 'k')
+        fit_queue = getattr(self.master, 'FitQueue', None)
+        
+        updated = []
+        while self.n_plotted < len(self.expt.spectra):
+            spec = self.expt.spectra[self.n_plotted]
+            if needs_fit and fit_queue and fit_queue.pending(spec):
+                break
+            ax_key = [key for key in self.xdata.keys() if spec.name.startswith(key)][0]
+            self.process_spectrum(ax_key, spec, selection, option)
+            self.last_spectrum = spec
+            self.n_plotted += 1
+            if ax_key not in updated:
+                updated.append(ax_key)
+        
+        for ax_key in updated:
+            self.update_axlim(ax_key) # Check if we need to adjust the axis limits
+            self._draw_blit(ax_key)
     
     
     def process_spectrum(self, ax_key, spectrum, selection, option):
@@ -170,7 +189,8 @@ class MonitorWindow:
         Extract the requested piece of information out of the spectrum
         
         Spectrum: ImpedanceSpectrum
-        selection: one of '|Z|', 'Phase', 'Parameter', 'k'.
+        selection: one of '|Z|', 'Phase', 'Parameter', 'k', 'k (live)', 
+                   'THD'.
         option: a number (meaning a frequency) or string (corresponding
                 to an EEC parameter)
         I.e. selection = '|Z|', option = 100.0: plot |Z|(100Hz) vs t
@@ -202,6 +222,17 @@ class MonitorWindow:
             except:
                 val= 0
             self.ydata[ax_key].append(val)
+            return
+        
+        if selection == 'k (live)':
+            track = spectrum.track or {}
+            self.ydata[ax_key].append(track.get('k', 0))
+            self.yerr[ax_key].append(track.get('k_std', 0))
+            return
+        
+        if selection == 'THD':
+            val = spectrum.thd if spectrum.thd is not None else 0
+            self.ydata[ax_key].append(100*val) # in %
         
         else:
             # TODO: implement once fitting is working
@@ -297,6 +328,19 @@ class MonitorWindow:
             self.lns[ax_key].set_data(self.xdata[ax_key], 
                                       self.ydata[ax_key])
         
+        # +- 1 std. dev. of live estimates
+        if len(self.yerr[ax_key]) == len(self.ydata[ax_key]) > 0:
+            y   = np.array(self.ydata[ax_key])
+            err = np.array(self.yerr[ax_key])
+            if ax_key not in self.err_lns:
+                self.err_lns[ax_key] = [
+                    self.axes[ax_key].plot(self.xdata[ax_key], y + sign*err, 
+                                           '-', color='gray', animated=True)[0]
+                    for sign in (1, -1)]
+            for sign, ln in zip((1, -1), self.err_lns[ax_key]):
+                ln.set_data(self.xdata[ax_key], y + sign*err)
+                self.axes[ax_key].draw_artist(ln)
+        
         for key, ln in self.lns.items():
             self.axes[ax_key].draw_artist(ln)
         self.bg = self.canvas.copy_from_bbox(self.fig.bbox)
@@ -316,14 +360,17 @@ class MonitorWindow:
         
         for key in self.xdata.keys():
             self.redraw_axes(key, selection, option)
+        self.n_plotted = len(self.expt.spectra)
     
     
     def redraw_axes(self, ax_key, selection, option):
         
         self.xdata[ax_key] = []
         self.ydata[ax_key] = []
+        self.yerr[ax_key]  = []
         
         self.axes[ax_key].clear()
+        self.err_lns.pop(ax_key, None)
         self.axes[ax_key].set_title(ax_key)
         self.axes[ax_key].y_lim_forced = False
         
@@ -363,12 +410,11 @@ class MonitorWindow:
         
         if self.display_selection.get() == 'Parameter':
             circuit = self.master.GUI.fit_circuit.get()
-            params = list(circuit_params[circuit].keys())
-            params.remove('_img')
+            params = list(get_circuit(circuit).params)
             self.display_option_menu.set_menu(params[0], *params)
             return
         
-        if self.display_selection.get() == 'k':
+        if self.display_selection.get() in ('k', 'k (live)', 'THD'):
             self.display_option_menu.set_menu('-', *['-',])
             return
             
@@ -8,11 +8,11 @@ import pyvisa
 if __name__ == '__main__':
     from Buffer import ADCDataBuffer
     from DataProcessor import DataProcessor
-    from funcs import run
+    from funcs import run, adc_to_volts
 else:
     from .Buffer import ADCDataBuffer
     from .DataProcessor import DataProcessor
-    from .funcs import run    
+    from .funcs import run, adc_to_volts
 
 
 tdivs = ['1NS', '2NS', '5NS', '10NS', '20NS', '50NS', 
@@ -198,13 +198,17 @@ class Oscilloscope():
         wave2  = trace2[22:-2]
         adc2   = np.array(array('b', wave2))
         
-        volts1 = adc1*(vdiv1/25) - voffset1
-        volts2 = adc2*(vdiv2/25) - voffset2
+        volts1 = adc_to_volts(adc1, vdiv1, voffset1)
+        volts2 = adc_to_volts(adc2, vdiv2, voffset2)
         if add_to_buffer:
-            self.buffer.append( (time.time(), 
+            timestamp = time.time()
+            self.buffer.append( (timestamp, 
                                  recording_params, 
                                  volts1, volts2,
                                  name) )
+            archive = self.master.experiment.raw_archive
+            if archive is not None:
+                archive.append(timestamp, recording_params, adc1, adc2, name)
         self._is_recording = False
 #        self.inst.write('TRMD AUTO')
         return volts1, volts2
@@ -0,0 +1,107 @@
+'''
+Convert an experiment folder into Parquet tables for analysis:
+
+    spectra.parquet   Z of every spectrum, long or wide form
+    times.parquet     timestamp of every spectrum
+    fits.parquet      contents of !fits.csv, if there is one
+
+Every table has dictionary-encoded "sensor" and "concentration" columns,
+parsed from titration file names like s2_10uM.txt (null for 000001.txt).
+Read them back with analysis/read_parquet.py.
+
+Requires pyarrow (pip install pyarrow).
+
+Usage: python -m modules.ParquetExport <experiment folder> [long/wide]
+'''
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from .Loader import load_experiment
+from .funcs import sensor_conc
+
+
+
+def _labels(pa, names):
+    # Dictionary-encoded sensor and concentration columns
+    sensors, concs = zip(*[sensor_conc(name) for name in names]) if names else ((), ())
+    return {'sensor'       : pa.array(sensors, pa.string()).dictionary_encode(),
+            'concentration': pa.array(concs, pa.string()).dictionary_encode()}
+
+
+
+def export_parquet(folder, out_path=None, layout='long', row_group_size=100000):
+    '''
+    folder: experiment folder
+    out_path: folder to write tables to, default <folder>/parquet
+    layout: 'long', one row per (spectrum, frequency) with columns
+            freq, re, im. Or 'wide', one row per spectrum with columns
+            re_<freq>, im_<freq>
+    row_group_size: rows per Parquet row group. Row group statistics are
+                    what lets readers skip data when filtering
+
+    Returns: out_path
+    '''
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Parquet export requires pyarrow: pip install pyarrow')
+
+    if layout not in ('long', 'wide'):
+        raise ValueError(f'layout must be "long" or "wide", not {layout}')
+
+    out_path = out_path or os.path.join(folder, 'parquet')
+    os.makedirs(out_path, exist_ok=True)
+
+    d       = load_experiment(folder)
+    n, nf   = d.Z.shape
+    index   = np.arange(1, n+1, dtype=np.int32)
+    labels  = _labels(pa, d.names)
+
+    # Times
+    times = pa.table({'index': index,
+                      'time' : d.times,
+                      'file' : pa.array(d.names, pa.string()),
+                      **labels})
+    pq.write_table(times, os.path.join(out_path, 'times.parquet'))
+
+    # Spectra
+    if layout == 'long':
+        rows    = np.repeat(np.arange(n), nf)
+        columns = {'index': index[rows],
+                   'time' : d.times[rows],
+                   **{key: val.take(pa.array(rows))
+                      for key, val in labels.items()},
+                   'freq' : np.tile(d.freqs, n),
+                   're'   : d.Z.real.ravel(),
+                   'im'   : d.Z.imag.ravel()}
+    else:
+        columns = {'index': index, 'time': d.times, **labels}
+        for j, f in enumerate(d.freqs):
+            columns[f're_{f:g}'] = d.Z[:,j].real
+            columns[f'im_{f:g}'] = d.Z[:,j].imag
+    pq.write_table(pa.table(columns), os.path.join(out_path, 'spectra.parquet'),
+                   row_group_size=row_group_size)
+
+    # Fits
+    fits_file = os.path.join(folder, '!fits.csv')
+    if os.path.exists(fits_file):
+        df   = pd.read_csv(fits_file)
+        fits = pa.Table.from_pandas(df, preserve_index=False)
+        for key, val in _labels(pa, df['file'].tolist()).items():
+            fits = fits.append_column(key, val)
+        pq.write_table(fits, os.path.join(out_path, 'fits.parquet'),
+                       row_group_size=row_group_size)
+
+    print(f'Exported {n} spectra to {out_path}')
+    return out_path
+
+
+
+
+if __name__ == '__main__':
+    layout = sys.argv[2] if len(sys.argv) > 2 else 'long'
+    export_parquet(sys.argv[1], layout=layout)
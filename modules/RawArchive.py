@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import queue
+import threading
+
+import numpy as np
+
+
+
+def delta_encode(adc):
+    '''
+    First sample, then sample-to-sample differences. int8 arithmetic wraps
+    around, so this is exactly reversible with delta_decode. Differences of
+    an oversampled trace are small and compress much better than samples.
+    '''
+    adc = np.asarray(adc, dtype=np.int8)
+    d = np.empty_like(adc)
+    d[:1] = adc[:1]
+    d[1:] = adc[1:] - adc[:-1]
+    return d
+
+
+def delta_decode(d):
+    return np.cumsum(d, dtype=np.int8)
+
+
+
+class RawFrameArchive():
+    '''
+    Stores the raw int8 oscilloscope traces of each recorded frame, along
+    with its timestamp, recording parameters and name, so that spectra can
+    be regenerated later (see Replay.py).
+
+    Frames are grouped into chunks of up to frames_per_chunk frames. Each
+    chunk is delta-encoded and written as one compressed .npz file by a
+    background writer thread, so append() never waits on the disk. A
+    partially filled chunk is written once its oldest frame is max_age s
+    old, or on flush()/close().
+
+    Each written chunk gets one line in index.jsonl with its first frame
+    number, timestamps, recording params and names. Reading a frame only
+    loads the chunk it is in.
+
+    The DataProcessor settings which were used live (waveform, correction
+    factors, ...) are saved once in header.json.
+
+        header.json
+        index.jsonl
+        chunk_000000.npz
+        chunk_000001.npz
+        ...
+    '''
+    def __init__(self, path, frames_per_chunk=32, max_age=60):
+        self.path             = path
+        self.header_file      = os.path.join(path, 'header.json')
+        self.index_file       = os.path.join(path, 'index.jsonl')
+        self.frames_per_chunk = frames_per_chunk
+        self.max_age          = max_age
+
+        self.chunks = []    # Index entries of written chunks
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r') as f:
+                self.chunks = [json.loads(line) for line in f if line.strip()]
+        self.n_written = sum(c['n'] for c in self.chunks)
+        self.n         = self.n_written # Including frames not yet written
+
+        self._cache  = (None, None) # (chunk number, decoded chunk)
+        self._queue  = queue.Queue()
+        self._writer = None
+        self._lock   = threading.Lock()
+
+
+    def __len__(self):
+        return self.n_written
+
+
+    def __getitem__(self, i):
+        '''
+        Returns: (timestamp, recording_params, adc1, adc2, name) of frame i
+        '''
+        if i < 0:
+            i += self.n_written
+        if not 0 <= i < self.n_written:
+            raise IndexError(f'Frame {i} not in archive of {self.n_written} frames')
+
+        firsts = [c['first'] for c in self.chunks]
+        c = int(np.searchsorted(firsts, i, side='right')) - 1
+        chunk = self.chunks[c]
+        adc1, adc2 = self._load_chunk(c)
+        j = i - chunk['first']
+        return (chunk['timestamps'][j], chunk['params'][j],
+                adc1[j], adc2[j], chunk['names'][j])
+
+
+    def __iter__(self):
+        for i in range(self.n_written):
+            yield self[i]
+
+
+    def _load_chunk(self, c):
+        # Keep the last chunk decoded, frames are usually read in order
+        if self._cache[0] == c:
+            return self._cache[1]
+
+        file = os.path.join(self.path, self.chunks[c]['file'])
+        with np.load(file) as d:
+            splits = np.cumsum(d['lengths'])[:-1]
+            adc1 = np.split(delta_decode(d['adc1']), splits)
+            adc2 = np.split(delta_decode(d['adc2']), splits)
+
+        self._cache = (c, (adc1, adc2))
+        return adc1, adc2
+
+
+    def has_header(self):
+        return os.path.exists(self.header_file)
+
+
+    def write_header(self, settings):
+        '''
+        settings: dict of json-able processing settings, see
+                  DataProcessor.settings()
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.header_file, 'w') as f:
+            json.dump(settings, f)
+
+
+    def header(self):
+        with open(self.header_file, 'r') as f:
+            return json.load(f)
+
+
+    def append(self, timestamp, recording_params, adc1, adc2, name):
+        '''
+        Queue one frame to be written. Returns immediately
+        '''
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop,
+                                                daemon=True)
+                self._writer.start()
+        self._queue.put((timestamp, recording_params,
+                         np.asarray(adc1, dtype=np.int8),
+                         np.asarray(adc2, dtype=np.int8),
+                         name))
+        self.n += 1
+
+
+    def flush(self):
+        '''
+        Write all queued frames, including a partial chunk, and wait
+        until they are on disk
+        '''
+        if self._writer is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+
+    def _write_loop(self):
+        frames = []
+        while True:
+            try:
+                item = self._queue.get(timeout=1)
+            except queue.Empty:
+                item = False
+
+            if isinstance(item, tuple):
+                frames.append(item)
+                if len(frames) >= self.frames_per_chunk:
+                    self._write_chunk(frames)
+                    frames = []
+                continue
+
+            # Flush, close, or idle: write out a partial chunk if needed
+            if frames and (item is not False or
+                           time.time() - frames[0][0] > self.max_age):
+                self._write_chunk(frames)
+                frames = []
+            if isinstance(item, threading.Event):
+                item.set()
+            if item is None:
+                return
+
+
+    def _write_chunk(self, frames):
+        os.makedirs(self.path, exist_ok=True)
+        timestamps, params, adc1, adc2, names = zip(*frames)
+        c    = len(self.chunks)
+        file = f'chunk_{c:06}.npz'
+
+        # Write under a temporary name so a chunk file is always complete
+        tmp = os.path.join(self.path, f'_{file}')
+        np.savez_compressed(tmp,
+                            adc1    = delta_encode(np.concatenate(adc1)),
+                            adc2    = delta_encode(np.concatenate(adc2)),
+                            lengths = np.array([len(a) for a in adc1]))
+        os.replace(tmp, os.path.join(self.path, file))
+
+        entry = {'file'      : file,
+                 'first'     : self.n_written,
+                 'n'         : len(frames),
+                 'timestamps': list(timestamps),
+                 'params'    : list(params),
+                 'names'     : list(names)}
+        with open(self.index_file, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+        self.chunks.append(entry)
+        self.n_written += len(frames)
+
@@ -0,0 +1,150 @@
+'''
+Reprocess an experiment from its raw frame archive (<experiment>/raw, saved
+when "Save raw frames" is checked) as fast as the CPU allows.
+
+By default the same processing settings and reference correction factors
+as the live run are used, which reproduces its output files exactly. Set
+archived_corrections=False to apply the current reference spectrum instead.
+
+Usage: python -m modules.Replay <experiment folder> [output folder]
+'''
+import os
+import sys
+import time
+import shutil
+
+import numpy as np
+
+from .Buffer import ADCDataBuffer
+from .DataProcessor import DataProcessor
+from .DataStorage import Experiment
+from .FitQueue import FitQueue
+from .RawArchive import RawFrameArchive
+from .Waveform import Waveform
+from .funcs import adc_to_volts
+
+
+
+class Setting():
+    '''
+    Read-only stand-in for a tkinter Variable
+    '''
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+
+class ReplayGUI():
+    '''
+    Options which DataProcessor normally reads from the GUI, as they were
+    set during the live run
+    '''
+    def __init__(self, header, fitter=None):
+        self.willStop = False
+        self.ref_correction_bool = Setting(header['ref_correction'])
+        self.period_avg_bool     = Setting(header['period_averaging'])
+        self.fit_bool            = Setting(fitter is not None)
+        if fitter is not None:
+            self.fitter = fitter
+
+
+
+class ReplayMaster():
+    '''
+    Stands in for MasterModule when there is no hardware or GUI
+    '''
+    def __init__(self, header, fitter=None):
+        self.willStop = False
+        self.STOP  = False
+        self.ABORT = False
+        self.modules = [self]
+
+        self.GUI        = ReplayGUI(header, fitter)
+        self.waveform   = Waveform(freqs  = np.array(header['freqs']),
+                                   phases = np.array(header['phases']),
+                                   amps   = np.array(header['amps']))
+        self.experiment = None
+
+
+    def register(self, module):
+        setattr(self, module.__class__.__name__, module)
+        self.modules.append(getattr(self, module.__class__.__name__))
+
+
+    def set_experiment(self, Experiment):
+        self.experiment = Experiment
+
+
+
+def replay(archive_path, out_path, fitter=None, archived_corrections=True):
+    '''
+    Feed every frame in a RawFrameArchive through DataProcessor, with no
+    waiting between frames, and save the results as a new Experiment.
+
+    archive_path: folder of the RawFrameArchive (<experiment>/raw)
+    out_path: folder to save the regenerated spectra to
+    fitter: Fitter object to fit the spectra with, or None for no fitting
+    archived_corrections: bool, use the correction factors from the live
+                          run. Otherwise load them from waveforms/reference
+
+    Returns: Experiment
+    '''
+    archive = RawFrameArchive(archive_path)
+    header  = archive.header()
+
+    master    = ReplayMaster(header, fitter)
+    processor = DataProcessor(master, ADCDataBuffer())
+    fit_queue = FitQueue(master)
+
+    expt = Experiment(master, path=out_path)
+    expt.set_waveform(master.waveform)
+    master.set_experiment(expt)
+    os.makedirs(out_path, exist_ok=True)
+
+    # Set up the DataProcessor like DataProcessor.run() would
+    processor.wf = master.waveform
+    if archived_corrections:
+        processor.applied_freqs = master.waveform.freqs
+        processor.Z_factors     = np.array(header['Z_factors'])
+        processor.phase_factors = np.array(header['phase_factors'])
+        processor.distortion.set_waveform(master.waveform)
+
+        # Settings are the same, so is the metadata
+        meta_file = os.path.join(os.path.dirname(archive_path), '!metadata.txt')
+        if os.path.exists(meta_file):
+            shutil.copy(meta_file, expt.meta_file)
+    else:
+        processor.load_correction_factors()
+        with open(expt.meta_file, 'w') as f:
+            f.write(f'Replayed from {archive_path}\n\n')
+            f.write(f'Waveform: {master.waveform.name()}\n')
+            f.write(f'Frequencies: {master.waveform.freqs}\n\n')
+            f.write(f'Z correction factors: {processor.Z_factors}\n\n')
+            f.write(f'Phase corrections: {processor.phase_factors}\n\n')
+
+    st = time.time()
+    for timestamp, params, adc1, adc2, name in archive:
+        volts1 = adc_to_volts(adc1, params['vdiv1'], params['voffset1'])
+        volts2 = adc_to_volts(adc2, params['vdiv2'], params['voffset2'])
+        processor.process(timestamp, params, volts1, volts2, name)
+        fit_queue.drain()
+
+    expt.close()
+    print(f'Replayed {len(archive)} frames in {time.time() - st:0.1f} s')
+    for sensor, warm_start in fit_queue.warm_starts.items():
+        print(f'Fits{f" ({sensor})" if sensor else ""}: {warm_start.stats()}')
+    return expt
+
+
+
+
+if __name__ == '__main__':
+    folder = sys.argv[1]
+    if len(sys.argv) > 2:
+        out_path = sys.argv[2]
+    else:
+        out_path = folder.rstrip('/\\') + ' replay'
+    replay(os.path.join(folder, 'raw'), out_path)
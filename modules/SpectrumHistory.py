@@ -0,0 +1,202 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+
+class SpectrumBlock():
+    '''
+    Experiment-level (row x frequency) arrays of Z, snr and Z_err which
+    ImpedanceSpectrum objects point into, so each spectrum only holds a
+    row number. All rows share one frequency vector. Columns which a 
+    spectrum doesn't have (e.g. Z_err without period averaging) are
+    flagged as missing and read back as None.
+    '''
+    columns = {'Z': 'complex128', 'snr': 'float64', 'Z_err': 'float64'}
+
+    def __init__(self, freqs, n_rows):
+        self.freqs  = np.asarray(freqs)
+        self.n_rows = n_rows
+        shape       = (n_rows, len(self.freqs))
+        self.data   = {c: np.zeros(shape, dtype=dtype)
+                       for c, dtype in self.columns.items()}
+        self.has    = {c: np.zeros(n_rows, dtype=bool) for c in self.columns}
+
+
+    def fits(self, spectrum):
+        return (len(spectrum.Z) == len(self.freqs) and
+                (spectrum.freqs is self.freqs or 
+                 np.array_equal(spectrum.freqs, self.freqs)))
+
+
+    def get(self, column, row):
+        if not self.has[column][row]:
+            return None
+        return self.data[column][row]
+
+
+    def set(self, column, row, values):
+        self.has[column][row] = values is not None
+        if values is not None:
+            self.data[column][row] = values
+
+
+    def attach(self, spectrum, row):
+        '''
+        Move spectrum's Z, snr and Z_err into row
+        '''
+        values = {c: spectrum._get(c) for c in self.columns}
+        for c in self.columns:
+            self.set(c, row, values[c])
+            setattr(spectrum, f'_{c}', None)
+        spectrum._block = self
+        spectrum._row   = row
+        spectrum.freqs  = self.freqs
+
+
+
+class SpectrumHistory():
+    '''
+    List-like container of an Experiment's spectra which only keeps the
+    most recent `window` spectra in memory, with their data in a shared
+    SpectrumBlock. Older spectra are read back
+    from the experiment's SpectrumStore when accessed, and the last
+    `cache_size` of those are kept in an LRU cache.
+
+    Supports len(), indexing and slicing (with negative indices),
+    iteration, and lookup by timestamp with at_time().
+
+    load: function(start, stop) returning a list of ImpedanceSpectrum for
+          positions start to stop (exclusive) from disk
+    find_time: function(t) returning the position of the last spectrum on
+               disk recorded at or before t
+    '''
+    def __init__(self, load, find_time, window=1000, cache_size=200):
+        self.load       = load
+        self.find_time  = find_time
+        self.window     = window
+        self.cache_size = cache_size
+        self.n          = 0              # Total number of spectra
+        # Ring buffer of the recent spectra, position p in slot p % window
+        self.recent     = [None]*window  # (position, spectrum)
+        self.cache      = OrderedDict()  # {position: spectrum}
+        self.block      = None           # SpectrumBlock of recent spectra
+
+
+    def __len__(self):
+        return self.n
+
+
+    def __repr__(self):
+        return (f'<SpectrumHistory: {self.n} spectra, '
+                f'{self.n - self.first_recent} in memory>')
+
+
+    @property
+    def first_recent(self):
+        # Position of the oldest spectrum still in memory
+        return max(self.n - self.window, 0)
+
+
+    def _recent(self, i):
+        '''
+        Returns: spectrum at position i if it is in memory, otherwise None
+        '''
+        item = self.recent[i % self.window]
+        # Another thread may have replaced the slot since i was checked
+        if item is not None and item[0] == i:
+            return item[1]
+        return None
+
+
+    def append(self, spectrum):
+        if self.block is None:
+            # Rows are reused 64 spectra after they leave memory,
+            # so other threads have time to finish with them
+            self.block = SpectrumBlock(spectrum.freqs, self.window + 64)
+
+        slot = self.n % self.window
+        if self.recent[slot] is not None:
+            _, evicted = self.recent[slot]
+            if evicted._block is self.block:
+                evicted.detach()
+
+        row = self.n % self.block.n_rows
+        if self.block.fits(spectrum):
+            spectrum.detach()
+            self.block.attach(spectrum, row)
+
+        self.recent[slot] = (self.n, spectrum)
+        self.n += 1
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.n))]
+
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError(f'Spectrum {i} out of range for {self.n} spectra')
+
+        if i >= self.first_recent:
+            spectrum = self._recent(i)
+            if spectrum is not None:
+                return spectrum
+
+        if i in self.cache:
+            self.cache.move_to_end(i)
+            return self.cache[i]
+
+        spectrum = self.load(i, i+1)[0]
+        self.cache[i] = spectrum
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return spectrum
+
+
+    def __iter__(self, block=256):
+        # Read old spectra from disk in blocks, without caching them
+        i = 0
+        while i < self.first_recent:
+            stop = min(i + block, self.first_recent)
+            for spectrum in self.load(i, stop):
+                yield spectrum
+            i = stop
+        for position in range(max(i, self.first_recent), self.n):
+            spectrum = self._recent(position)
+            if spectrum is None:
+                spectrum = self[position]
+            yield spectrum
+
+
+    def index_at(self, t):
+        '''
+        Position of the last spectrum recorded at or before time t,
+        or -1 if there is none
+        '''
+        # Binary search of the spectra in memory
+        lo, hi = self.first_recent, self.n
+        first  = self._recent(lo) if lo < hi else None
+        if first is not None and t >= first.timestamp:
+            while hi - lo > 1:
+                mid = (lo + hi)//2
+                spectrum = self._recent(mid)
+                if spectrum is None:
+                    spectrum = self[mid]
+                if spectrum.timestamp <= t:
+                    lo = mid
+                else:
+                    hi = mid
+            return lo
+        return min(self.find_time(t), self.first_recent - 1)
+
+
+    def at_time(self, t):
+        '''
+        Returns: the last spectrum recorded at or before time t
+        '''
+        i = self.index_at(t)
+        if i < 0:
+            raise IndexError(f'No spectrum recorded before t = {t}')
+        return self[i]
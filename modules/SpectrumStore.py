@@ -0,0 +1,422 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+if __name__ == '__main__':
+    from Journal import repair
+else:
+    from .Journal import repair
+
+
+
+class SpectrumStore():
+    '''
+    Append-only columnar storage for all spectra of an Experiment. Instead
+    of one text file per spectrum, each quantity is appended to a single
+    growing binary file:
+
+        header.json   frequencies (written once) and column dtypes
+        t.bin         float64 timestamp of each spectrum
+        Z.bin         complex Z, n_freqs values per spectrum
+        snr.bin       float64 SNR, n_freqs values per spectrum (NaN if unknown)
+        Z_err.bin     float64 standard error of Z, n_freqs values per spectrum
+        thd.bin       float64 harmonic distortion of each spectrum
+        names.txt     name of each spectrum, one per line ('' if None)
+        names.idx     int64 offset of each spectrum's line in names.txt
+        fits.bin      (row, fit values) records, in the order fits finished.
+                      Fit parameter names are in the header
+
+    Row i of every column belongs to the same spectrum. Read it back with
+    load_store(), or single rows with read().
+    '''
+    version = 1
+
+    def __init__(self, path, Z_dtype='complex128'):
+        self.path        = path
+        self.header_file = os.path.join(path, 'header.json')
+        self.Z_dtype     = Z_dtype
+        self.freqs       = None
+        self.fit_keys    = None
+        self._files      = {}
+        self._name_pos   = 0
+
+        if os.path.exists(self.header_file):
+            header        = read_header(path)
+            self.freqs    = np.array(header['freqs'])
+            self.Z_dtype  = header['columns']['Z']
+            self.fit_keys = header.get('fit_keys')
+            self.repair()
+            names = os.path.join(path, 'names.txt')
+            if os.path.exists(names):
+                self._name_pos = os.path.getsize(names)
+
+
+    def _file(self, column, mode='ab'):
+        # Keep files open between appends
+        if column not in self._files:
+            self._files[column] = open(os.path.join(self.path, column), mode)
+        return self._files[column]
+
+
+    def _header(self):
+        return {
+            'version' : self.version,
+            'freqs'   : self.freqs.tolist(),
+            'columns' : {'t'    : 'float64',
+                         'Z'    : self.Z_dtype,
+                         'snr'  : 'float64',
+                         'Z_err': 'float64',
+                         'thd'  : 'float64'},
+            'fit_keys': self.fit_keys,
+            }
+
+
+    def write_header(self, freqs):
+        os.makedirs(self.path, exist_ok=True)
+        self.freqs = np.asarray(freqs)
+        with open(self.header_file, 'w') as f:
+            json.dump(self._header(), f)
+
+
+    def matches(self, freqs):
+        '''
+        True if spectra at freqs can be appended to this store
+        '''
+        if self.freqs is None:
+            return True
+        freqs = np.asarray(freqs)
+        return (freqs.shape == self.freqs.shape and 
+                np.allclose(freqs, self.freqs, rtol=1e-9, atol=0))
+
+
+    def rotate(self):
+        '''
+        Move this (closed) store's folder aside, to spectra_01, 
+        spectra_02, ..., so a new store can start in its place
+
+        Returns: new folder of the old store
+        '''
+        i = 1
+        while os.path.exists(f'{self.path}_{i:02}'):
+            i += 1
+        os.rename(self.path, f'{self.path}_{i:02}')
+        return f'{self.path}_{i:02}'
+
+
+    def append(self, spectrum):
+        self.append_many([spectrum])
+
+
+    def append_many(self, spectra):
+        '''
+        Append a batch of spectra with one write per column. Spectra with
+        the wrong number of frequencies are skipped, and raise ValueError
+        once the rest are written
+        '''
+        if not spectra:
+            return
+        if self.freqs is None:
+            self.write_header(spectra[0].freqs)
+
+        n_freqs = len(self.freqs)
+        bad     = [s for s in spectra if len(s.Z) != n_freqs]
+        spectra = [s for s in spectra if len(s.Z) == n_freqs]
+
+        def _rows(values):
+            return np.array([np.full(n_freqs, np.nan) if v is None else v
+                             for v in values], dtype='float64')
+
+        names   = [f'{s.name or ""}\n'.encode() for s in spectra]
+        offsets = self._name_pos + np.cumsum([0] + [len(n) for n in names])
+        columns = {
+            'Z.bin'    : np.array([s.Z for s in spectra], dtype=self.Z_dtype),
+            'snr.bin'  : _rows([s.snr for s in spectra]),
+            'Z_err.bin': _rows([s.Z_err for s in spectra]),
+            'thd.bin'  : np.array([np.nan if s.thd is None else s.thd
+                                   for s in spectra], dtype='float64'),
+            'names.idx': offsets[:-1].astype('int64'),
+            }
+        for column, values in columns.items():
+            self._file(column).write(values.tobytes())
+        self._file('names.txt').write(b''.join(names))
+        self._name_pos = int(offsets[-1])
+
+        # Timestamps go last, and only once the rest of the batch has left
+        # our buffers, so t.bin is never ahead of the other columns
+        for column in list(columns) + ['names.txt']:
+            self._files[column].flush()
+        self._file('t.bin').write(
+            np.array([s.timestamp for s in spectra], dtype='float64').tobytes())
+
+        if bad:
+            raise ValueError(f'{len(bad)} spectra have {len(bad[0].Z)} '
+                             f'frequencies, store has {n_freqs}')
+
+
+    def append_fit(self, row, fit):
+        '''
+        Save the fit dict of the spectrum in row
+        '''
+        if self.fit_keys is None:
+            self.fit_keys = list(fit.keys())
+            with open(self.header_file, 'w') as f:
+                json.dump(self._header(), f)
+        if list(fit.keys()) != self.fit_keys:
+            print(f'Fit parameters {list(fit.keys())} do not match ' +
+                  f'{self.fit_keys}, fit not saved to {self.path}')
+            return
+        record = np.array([(row, list(fit.values()))],
+                          dtype=fit_dtype(self.fit_keys))
+        self._file('fits.bin').write(record.tobytes())
+
+
+    def flush(self, sync=False):
+        '''
+        Push appended rows to the OS, and to disk with fsync if sync=True.
+        Timestamps go last, so a row only counts once everything else for
+        it is written
+        '''
+        columns = [c for c in ['Z.bin', 'snr.bin', 'Z_err.bin', 'thd.bin',
+                               'names.txt', 'names.idx', 'fits.bin', 't.bin']
+                   if c in self._files]
+        for column in columns:
+            self._files[column].flush()
+        if sync:
+            for column in columns:
+                os.fsync(self._files[column].fileno())
+
+
+    def repair(self):
+        '''
+        Cut all columns back to the rows which were completely written,
+        in case the program died partway through an append. That is the
+        smallest number of whole rows in any column, not just t.bin
+        '''
+        n_freqs = len(self.freqs)
+        sizes   = {'t.bin'    : 8,
+                   'Z.bin'    : np.dtype(self.Z_dtype).itemsize * n_freqs,
+                   'snr.bin'  : 8 * n_freqs,
+                   'Z_err.bin': 8 * n_freqs,
+                   'thd.bin'  : 8,
+                   'names.idx': 8}
+
+        def _size(column):
+            file = os.path.join(self.path, column)
+            return os.path.getsize(file) if os.path.exists(file) else 0
+
+        n = min(_size(column) // size for column, size in sizes.items())
+        n = min(n, count_lines(os.path.join(self.path, 'names.txt')))
+
+        for column, size in sizes.items():
+            file = os.path.join(self.path, column)
+            if os.path.exists(file) and os.path.getsize(file) > n*size:
+                os.truncate(file, n*size)
+        repair(os.path.join(self.path, 'names.txt'), keep=n)
+
+        if self.fit_keys is not None:
+            # Whole records only
+            record = fit_dtype(self.fit_keys).itemsize
+            file   = os.path.join(self.path, 'fits.bin')
+            if os.path.exists(file) and os.path.getsize(file) % record:
+                os.truncate(file, os.path.getsize(file) // record * record)
+
+
+    def close(self):
+        self.flush()
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+    def __len__(self):
+        # Number of complete rows on disk
+        file = os.path.join(self.path, 't.bin')
+        if not os.path.exists(file):
+            return 0
+        return os.path.getsize(file) // 8
+
+
+    def _read(self, column, dtype, start, stop, width=1):
+        itemsize = np.dtype(dtype).itemsize * width
+        with open(os.path.join(self.path, column), 'rb') as f:
+            f.seek(start*itemsize)
+            vals = np.fromfile(f, dtype=dtype, count=(stop-start)*width)
+        if width > 1:
+            vals = vals.reshape(stop-start, width)
+        return vals
+
+
+    def read(self, start, stop):
+        '''
+        Read rows start to stop (exclusive) without loading the rest of
+        the store.
+
+        Returns: dict like load_store(), plus 'fits': list of dict or None
+        '''
+        columns = self._header()['columns']
+        n_freqs = len(self.freqs)
+        d = {'freqs': self.freqs,
+             't'    : self._read('t.bin', columns['t'], start, stop),
+             'thd'  : self._read('thd.bin', columns['thd'], start, stop)}
+        for column in ['Z', 'snr', 'Z_err']:
+            d[column] = self._read(f'{column}.bin', columns[column], 
+                                   start, stop, n_freqs)
+
+        # Names: lines between the first and last offsets
+        offsets = self._read('names.idx', 'int64', start, stop+1)
+        with open(os.path.join(self.path, 'names.txt'), 'rb') as f:
+            f.seek(offsets[0])
+            size = offsets[-1] - offsets[0] if len(offsets) > stop-start else -1
+            d['names'] = f.read(size).decode().split('\n')[:stop-start]
+
+        d['fits'] = [None]*(stop-start)
+        fits = self.fits()
+        if fits is not None:
+            for rec in fits[(fits['row'] >= start) & (fits['row'] < stop)]:
+                d['fits'][rec['row'] - start] = dict(zip(self.fit_keys, 
+                                                  rec['values'].tolist()))
+        return d
+
+
+    def fits(self):
+        '''
+        Returns: memory-mapped record array of (row, values), or None
+        '''
+        file = os.path.join(self.path, 'fits.bin')
+        if self.fit_keys is None or not os.path.exists(file):
+            return None
+        dtype = fit_dtype(self.fit_keys)
+        n = os.path.getsize(file) // dtype.itemsize
+        if n == 0:
+            return None
+        return np.memmap(file, dtype=dtype, mode='r', shape=(n,))
+
+
+    def find_time(self, t):
+        '''
+        Returns: row of the last spectrum recorded at or before t
+        '''
+        n = len(self)
+        if n == 0:
+            return -1
+        ts = np.memmap(os.path.join(self.path, 't.bin'), dtype='float64',
+                       mode='r', shape=(n,))
+        return int(np.searchsorted(ts, t, side='right')) - 1
+
+
+
+def fit_dtype(fit_keys):
+    return np.dtype([('row', 'int64'), ('values', 'float64', len(fit_keys))])
+
+
+
+def count_lines(path, chunk=1<<20):
+    '''
+    Number of complete (newline-terminated) lines in a file, 0 if it
+    doesn't exist
+    '''
+    if not os.path.exists(path):
+        return 0
+    n = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk)
+            if not data:
+                return n
+            n += data.count(b'\n')
+
+
+
+def read_header(path):
+    with open(os.path.join(path, 'header.json'), 'r') as f:
+        return json.load(f)
+
+
+
+def load_store(path):
+    '''
+    Read all columns of a SpectrumStore.
+
+    path: store folder (<experiment>/spectra)
+
+    Returns: dict of
+        'freqs': (n_freqs,) array
+        't', 'thd': (n_spectra,) arrays
+        'Z', 'snr', 'Z_err': (n_spectra, n_freqs) arrays
+        'names': list of n_spectra strings
+    '''
+    header  = read_header(path)
+    freqs   = np.array(header['freqs'])
+    columns = header['columns']
+    n_freqs = len(freqs)
+
+    t = np.fromfile(os.path.join(path, 't.bin'), dtype=columns['t'])
+    n = len(t)
+
+    d = {'freqs': freqs, 't': t}
+    for column in ['Z', 'snr', 'Z_err']:
+        vals = np.fromfile(os.path.join(path, f'{column}.bin'),
+                           dtype=columns[column])
+        d[column] = vals[:n*n_freqs].reshape(n, n_freqs)
+    d['thd'] = np.fromfile(os.path.join(path, 'thd.bin'),
+                           dtype=columns['thd'])[:n]
+
+    with open(os.path.join(path, 'names.txt'), 'rb') as f:
+        d['names'] = f.read().decode().split('\n')[:n]
+    return d
+
+
+
+def write_spectrum_txt(file, freqs, Z):
+    '''
+    Legacy tab-separated text file for one spectrum
+    '''
+    d = pd.DataFrame(
+        {'f': freqs,
+         're': np.real(Z),
+         'im': np.imag(Z)}
+        )
+    d.to_csv(file, columns = ['f', 're', 'im'],
+             header = ['<Frequency>', '<Re(Z)>', '<Im(Z)>'], 
+             sep = '\t', index = False, encoding='ascii')
+
+
+
+def write_row(file, freqs, values):
+    # One tab-separated row of values per spectrum, header is frequencies
+    if values is None:
+        return
+    if not os.path.exists(file):
+        with open(file, 'w') as f:
+            f.write('\t'.join(str(freq) for freq in freqs) + '\n')
+    with open(file, 'a') as f:
+        f.write('\t'.join(f'{val:.4e}' for val in values) + '\n')
+
+
+
+def export_txt(path):
+    '''
+    Write the legacy text output (000001.txt, ..., !snr.txt, !Z_err.txt)
+    of an experiment folder from its SpectrumStore.
+    
+    path: experiment folder
+    '''
+    d = load_store(os.path.join(path, 'spectra'))
+    for i, name in enumerate(d['names']):
+        if not name:
+            name = f'{i+1:06}.txt'
+        write_spectrum_txt(os.path.join(path, name), d['freqs'], d['Z'][i])
+        
+        for column, file in [('snr', '!snr.txt'), ('Z_err', '!Z_err.txt')]:
+            if not np.isnan(d[column][i]).all():
+                write_row(os.path.join(path, file), d['freqs'], d[column][i])
+    print(f'Exported {len(d["names"])} spectra to {path}')
+
+
+
+
+if __name__ == '__main__':
+    import sys
+    export_txt(sys.argv[1])
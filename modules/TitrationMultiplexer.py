@@ -3,7 +3,7 @@ import time
 from tkinter import simpledialog
 from functools import partial
 
-from .DataStorage import Experiment
+from .DataStorage import Experiment, average
 from .funcs import run
 
 
@@ -26,7 +26,7 @@ class TitrationMultiplexer:
         self.i         = 0
         
         self.saved_names = []
-        self.saved_specs = []
+        self.saved_specs = []   # Indices of spectra already averaged
         
         
         
@@ -68,6 +68,7 @@ class TitrationMultiplexer:
         # Creates a local Experiment which will save averaged spectra
         self.expt = Experiment(self.master, name = self.name)
         self.expt.set_waveform(self.master.waveform)
+        self.expt.save_txt = self.master.GUI.save_txt_bool.get()
     
     def check_action(self):
         
@@ -79,6 +80,7 @@ class TitrationMultiplexer:
         if self.needs_new_conc():
             r = self.prompt_conc()
             if not r:
+                self.expt.close()
                 self.master.GUI.idle()
                 return
             
@@ -130,18 +132,18 @@ class TitrationMultiplexer:
     
     def save_last_recording(self):
         spectra = self.master.experiment.spectra[-self.nframes:]
-        if any([s in self.saved_specs for s in spectra]):
+        if any([s.index in self.saved_specs for s in spectra]):
             return
         
         sensor = self.sensors[self.i%len(self.sensors)]
         fname = f'{sensor}_{self.conc}.txt'
         
-        avg            = spectra[0].average(spectra[1:])
+        avg            = average(spectra)
         avg.name       = fname
         avg.experiment = self.expt
         avg.fit = self.master.GUI.fitter.fit(avg)
         self.expt.append_spectrum(avg)
-        self.saved_specs.extend(spectra)
+        self.saved_specs.extend([s.index for s in spectra])
         self.saved_names.append(fname)
         self.i += 1
         print(f'Finished {sensor}, {self.conc}')
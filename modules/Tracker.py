@@ -0,0 +1,149 @@
+import threading
+from collections import deque
+
+import numpy as np
+
+from .Circuits import get_circuit
+
+
+
+class ParameterTracker():
+    '''
+    Live estimate of a circuit's parameters over a time series of
+    spectra, with an extended Kalman filter. Each new spectrum updates the
+    estimate with one linearized (Gauss-Newton) step instead of a full
+    fit, so it costs about one Jacobian evaluation.
+
+    The state is log(value) of each free parameter, which drifts as a
+    random walk between spectra. Residuals are modulus weighted, the same
+    as CNLS_fit, and the measurement noise is estimated from them as it
+    goes.
+
+    Full fits, which finish later in the background, correct the estimate
+    with correct().
+
+    circuit: str, name of a built-in circuit or a circuit string
+    guess: dict of {param: (value, free)} to start from
+    drift: expected relative change of each parameter per sqrt(second)
+    noise: initial relative noise of each point of Z
+    fit_error: relative error of full fits, for correct()
+    '''
+    def __init__(self, circuit, guess, drift=0.02, noise=0.01,
+                 fit_error=0.01, max_step=1):
+        self.circuit   = get_circuit(circuit)
+        self.names     = self.circuit.params
+        self.p0        = np.array([float(guess[name][0]) for name in self.names])
+        self.free      = np.array([bool(guess[name][1]) for name in self.names])
+        self.drift     = drift
+        self.noise     = noise
+        self.fit_error = fit_error
+        self.max_step  = max_step   # Largest change in log(value) per update
+
+        self.x = np.log(self.p0[self.free])
+        self.P = np.eye(len(self.x))*np.log(3)**2
+        self.t = None
+        self.history = deque(maxlen=1000)    # (t, x) after each update
+        self._lock   = threading.Lock()
+
+
+    def params(self, x=None):
+        p = self.p0.copy()
+        p[self.free] = np.exp(self.x if x is None else x)
+        return p
+
+
+    def update(self, t, freqs, Z):
+        '''
+        Update the estimate with the spectrum measured at time t
+
+        Returns: dict of the new estimate, see state()
+        '''
+        w = 2*np.pi*np.asarray(freqs, dtype=float)
+        Z = np.asarray(Z, dtype=complex)
+        with self._lock:
+            # Predict: parameters drift between spectra
+            if self.t is not None:
+                self.P = self.P + np.eye(len(self.x))*self.drift**2*max(t - self.t, 0)
+            self.t = t
+
+            # Update, in information form: only (n_free x n_free) inverses
+            p = self.params()
+            with np.errstate(all='ignore'):
+                Z_fit, dZ = self.circuit.dfunc(w, *p)
+            sigma = np.abs(Z)
+            r  = (Z_fit - Z)/sigma
+            dp = dZ[self.free]*p[self.free][:,None]/sigma
+            r  = np.concatenate([r.real, r.imag])
+            J  = np.concatenate([dp.real, dp.imag], axis=1)
+
+            if np.all(np.isfinite(r)) and np.all(np.isfinite(J)):
+                R  = self.noise**2
+                P  = np.linalg.inv(np.linalg.inv(self.P) + J @ J.T/R)
+                dx = -P @ (J @ r)/R
+                dx = np.clip(dx, -self.max_step, self.max_step)
+                self.x, self.P = self.x + dx, P
+
+                # Residual after the step, to follow the noise level
+                r_new = r + J.T @ dx
+                rms   = np.sqrt(np.mean(r_new**2))
+                self.noise = max(0.9*self.noise + 0.1*rms, 1e-4)
+
+            self.history.append((t, self.x.copy()))
+            return self._state()
+
+
+    def correct(self, t, fit):
+        '''
+        Correct the estimate with a full fit of the spectrum at time t.
+        The difference between the fit and the estimate at time t is
+        applied to the current estimate.
+
+        fit: dict of {param: value}
+        '''
+        with self._lock:
+            x_t = [x for ti, x in self.history if ti == t]
+            if not x_t:
+                return
+            try:
+                y = np.log([fit[name] for name in np.array(self.names)[self.free]])
+            except (KeyError, TypeError, ValueError):
+                return
+            if not np.all(np.isfinite(y)):
+                return
+            K  = self.P @ np.linalg.inv(self.P + np.eye(len(y))*self.fit_error**2)
+            dx = K @ (y - x_t[-1])
+            self.x = self.x + dx
+            self.P = (np.eye(len(y)) - K) @ self.P
+            # Estimates since t would have had this correction too, so
+            # later fits don't correct for it again
+            self.history = deque(((ti, x + dx) if ti >= t else (ti, x)
+                                  for ti, x in self.history),
+                                 maxlen=self.history.maxlen)
+
+
+    def state(self):
+        with self._lock:
+            return self._state()
+
+
+    def _state(self):
+        '''
+        Returns: dict of {param: value}, and {param}_std: standard deviation
+                 of each free parameter. For circuits with Rct and Cads,
+                 also k = 1/(2*Rct*Cads) and k_std
+        '''
+        p     = self.params()
+        state = dict(zip(self.names, p.tolist()))
+        std   = np.zeros(len(p))
+        std[self.free] = p[self.free]*np.sqrt(np.diag(self.P))
+        state.update({f'{name}_std': s for name, s in zip(self.names, std)})
+
+        if 'Rct' in self.names and 'Cads' in self.names:
+            # log(k) = -log(2) - log(Rct) - log(Cads)
+            g = np.zeros(len(p))
+            g[[self.names.index('Rct'), self.names.index('Cads')]] = -1
+            g = g[self.free]
+            k = 1/(2*state['Rct']*state['Cads'])
+            state['k']     = k
+            state['k_std'] = k*np.sqrt(g @ self.P @ g)
+        return state
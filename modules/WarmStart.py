@@ -0,0 +1,130 @@
+from collections import deque
+
+import numpy as np
+
+
+
+class WarmStart():
+    '''
+    Initial guesses for fitting a time series of spectra. Each parameter
+    is extrapolated to the next spectrum's time with a straight line
+    through the last k good fits, so a guess keeps up with fast changes
+    (e.g. a drug bolus) instead of lagging one spectrum behind.
+
+    After a failed fit the last good fit is used as is. After
+    max_failures failed fits in a row, guess() returns None so the
+    fitter starts over from its default guess.
+
+    k: number of fits to extrapolate from. 1 uses the last fit
+    log: bool, extrapolate log(value), so parameters stay positive and
+         exponential changes are followed exactly
+    max_step: largest factor a parameter can be extrapolated away from
+              its last fit value
+
+    n_fits, n_failed, n_iter, fit_time: totals, for comparing settings.
+    See stats()
+    '''
+    def __init__(self, k=3, log=True, max_failures=3, max_step=10):
+        self.k            = k
+        self.log          = log
+        self.max_failures = max_failures
+        self.max_step     = max_step
+        self.reset()
+
+        self.n_fits    = 0
+        self.n_failed  = 0
+        self.n_iter    = 0
+        self.n_counted = 0 # Fits which reported their iterations
+        self.n_timed   = 0
+        self.fit_time  = 0
+
+
+    def reset(self):
+        '''
+        Forget previous fits, e.g. at the start of a new experiment
+        '''
+        self.history  = deque(maxlen=self.k) # (t, fit dict)
+        self.failures = 0
+
+
+    def guess(self, t):
+        '''
+        t: time (or index) of the spectrum about to be fit
+
+        Returns: dict of {element: initial guess}, or None to use the
+                 default guess
+        '''
+        if not self.history or self.failures >= self.max_failures:
+            return None
+
+        t_last, last = self.history[-1]
+        if self.failures or len(self.history) < 2:
+            return dict(last)
+
+        ts = np.array([ti for ti, _ in self.history], dtype=float)
+        if np.ptp(ts) == 0:
+            return dict(last)
+
+        guess = {}
+        for key, val in last.items():
+            y = np.array([fit[key] for _, fit in self.history], dtype=float)
+            if self.log:
+                if np.any(y <= 0):
+                    guess[key] = val
+                    continue
+                y = np.log(y)
+            slope, intercept = np.polyfit(ts - t_last, y, 1)
+            pred = intercept + slope*(t - t_last)
+
+            if self.log:
+                step = np.log(self.max_step)
+                pred = np.exp(np.clip(pred, y[-1] - step, y[-1] + step))
+            elif not (val/self.max_step <= pred <= val*self.max_step):
+                pred = val
+            guess[key] = float(pred) if np.isfinite(pred) else val
+        return guess
+
+
+    def update(self, t, fit, info=None):
+        '''
+        Record the result of the fit of the spectrum at time t
+
+        fit: dict of fit parameters, or 0 if the fit failed
+        info: dict of fit info from Fitter.fit(), with 'n_iter' and 'time'
+        '''
+        info = info or {}
+        self.n_fits += 1
+        if 'n_iter' in info:
+            self.n_iter    += info['n_iter']
+            self.n_counted += 1
+        if 'time' in info:
+            self.n_timed  += 1
+            self.fit_time += info['time']
+
+        if type(fit) != dict:
+            self.n_failed += 1
+            self.failures += 1
+            return
+        if self.failures >= self.max_failures:
+            # Started over, older fits may be from before a big change
+            self.history.clear()
+        self.failures = 0
+        self.history.append((t, dict(fit)))
+
+
+    def add_stats(self, other):
+        '''
+        Add the fit totals of another WarmStart to this one's
+        '''
+        for attr in ('n_fits', 'n_failed', 'n_iter', 'n_counted', 'n_timed',
+                     'fit_time'):
+            setattr(self, attr, getattr(self, attr) + getattr(other, attr))
+
+
+    def stats(self):
+        line = f'{self.n_fits} fits, {self.n_failed} failed'
+        if self.n_counted:
+            line += f', {self.n_iter/self.n_counted:0.1f} iterations/fit'
+        if self.n_timed:
+            line += f', {1000*self.fit_time/self.n_timed:0.1f} ms/fit'
+        return line
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import threading
 
@@ -8,6 +9,20 @@ def nearest(array, value):
     return idx, array[idx]
 
 
+def adc_to_volts(adc, vdiv, voffset):
+    # Oscilloscope ADC counts to volts. 25 counts per vertical division
+    return adc*(vdiv/25) - voffset
+
+
+def sensor_conc(name):
+    # Titration file names: "s2_10uM.txt" -> ("s2", "10uM"), else (None, None)
+    name = os.path.splitext(name)[0]
+    if '_' not in name:
+        return None, None
+    sensor, conc = name.split('_', 1)
+    return sensor, conc
+
+
 def run(func, args=()):
     t = threading.Thread(target=func, args=args)
     t.start()
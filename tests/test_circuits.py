@@ -0,0 +1,89 @@
+'''
+Analytic Jacobians of the circuits in Circuits.py, checked against
+central finite differences, and the CNLS finite-difference fallback.
+
+Run with: python -m pytest tests
+'''
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.Circuits import get_circuit
+from modules.CNLS import CNLS_fit
+
+
+freqs = np.logspace(-1, 5, 40)
+w     = 2*np.pi*freqs
+
+
+
+def central_difference(circuit, p, rel_step=1e-6):
+    '''
+    Returns: (n_params, n_freqs) array of dZ/dparam
+    '''
+    J = np.zeros((len(p), len(w)), dtype=complex)
+    for i in range(len(p)):
+        h = rel_step*p[i]
+        up, down = p.copy(), p.copy()
+        up[i]   += h
+        down[i] -= h
+        J[i] = (circuit.func(w, *up) - circuit.func(w, *down))/(2*h)
+    return J
+
+
+
+def max_error(circuit, p):
+    '''
+    Largest difference between the analytic and finite-difference
+    dZ/dlog(p), relative to |Z|, so parameters of any size count the same
+    '''
+    Z, J = circuit.dfunc(w, *p)
+    assert np.allclose(Z, circuit.func(w, *p))
+    err = np.abs(J - central_difference(circuit, p))*p[:,None]/np.abs(Z)
+    return err.max()
+
+
+
+@pytest.mark.parametrize('name', ['RRC', 'Sensor', 'RRQ', 'Randles_uelec'])
+def test_dfunc_matches_finite_differences(name):
+    circuit = get_circuit(name)
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        # Defaults, scaled by up to 10x either way
+        p = np.array([val*np.exp(rng.uniform(-2.3, 2.3)) if free else val
+                      for val, free in circuit.defaults.values()])
+        err = max_error(circuit, p)
+        assert err < 1e-6, f'{name}: max relative error {err:.2e}'
+
+
+
+def test_shared_parameter_gradients_add():
+    # R1 appears twice, so its derivative is the sum of both elements'
+    circuit = get_circuit('R1-p(R1,C1)')
+    assert circuit.params == ('R1', 'C1')
+    assert max_error(circuit, np.array([100., 1e-6])) < 1e-6
+
+
+
+@pytest.mark.parametrize('name', ['RRC', 'Sensor'])
+def test_finite_difference_fallback(name):
+    circuit = get_circuit(name)
+    true  = {param: val*1.5 if free else val
+             for param, (val, free) in circuit.defaults.items()}
+    Z     = circuit.Z(freqs, true)
+    guess = {param: val for param, (val, _) in circuit.defaults.items()}
+    free  = {param: free for param, (_, free) in circuit.defaults.items()}
+
+    info_fd, info_an = {}, {}
+    fd = CNLS_fit(freqs, Z, guess, name, free, analytic=False, info=info_fd)
+    an = CNLS_fit(freqs, Z, guess, name, free, analytic=True, info=info_an)
+
+    assert fd and an
+    for param in circuit.params:
+        assert fd[param] == pytest.approx(true[param], rel=1e-4)
+        assert fd[param] == pytest.approx(an[param], rel=1e-4)
+    assert info_fd['n_iter'] > 0